@@ -35,6 +35,8 @@ import time
 import glob
 import sys
 import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 __author__  = "Aslak Grinsted"
@@ -44,6 +46,11 @@ __license__ = "Apache License, Version 2.0"
 slaveaddress = 1 # this is the address of the unit.
 REDIS_HOST = "localhost"
 
+# minimalmodbus shares one Serial object between all instruments on a port
+# name, so a port is only closed when the last Codex560 using it is released
+_port_users = {}
+_port_lock = threading.Lock()
+
 
 
 
@@ -68,8 +75,23 @@ class Codex560( minimalmodbus.Instrument ):
         self.serial.parity   = minimalmodbus.serial.PARITY_EVEN
         self.serial.stopbits = 1
         self.serial.timeout = 0.6
+        with _port_lock:
+            _port_users[self.serial] = _port_users.get(self.serial, 0) + 1
+        self.released = False
         time.sleep(0.05) #dont start reading immediately
 
+    def release(self):
+        """Closes the serial port, unless another Codex560 still uses it"""
+        if self.released:
+            return
+        self.released = True
+        with _port_lock:
+            users = _port_users.pop(self.serial, 1) - 1
+            if users > 0:
+                _port_users[self.serial] = users
+                return
+        self.serial.close()
+
 
     #
     #            GETTER METHODS
@@ -134,6 +156,14 @@ class Codex560( minimalmodbus.Instrument ):
         self.write_float(registeraddress = 0xA, value = value);
         return
 
+    def probe(self):
+        """True if a Codex 560 answers on this port"""
+        try:
+            self.get_status()
+            return True
+        except Exception:
+            return False
+
     #def store_set_value(self):
     #    self.write_float(registeraddress = 0xC,0.0);
     #    return
@@ -153,6 +183,38 @@ class Codex560( minimalmodbus.Instrument ):
     #    return
 
 
+def _probe_port(port, slaveaddress):
+    try:
+        instrument = Codex560(port, slaveaddress)
+    except Exception:
+        return None
+    if instrument.probe():
+        return instrument
+    instrument.release()
+    return None
+
+
+def find_codex560(ports, slaveaddress=slaveaddress):
+    """Probes all candidate ports at the same time and returns the first Codex560 found (or None).
+
+    Total time is one read timeout, not one per port.
+    """
+    ports = list(ports)
+    if not ports:
+        return None
+    with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        found = list(pool.map(lambda port: _probe_port(port, slaveaddress), ports))
+    result = None
+    for instrument in found:
+        if instrument is None:
+            continue
+        if result is None:
+            result = instrument
+        else:
+            instrument.release()
+    return result
+
+
 ########################
 ## Testing the module ##
 ########################
@@ -166,16 +228,10 @@ if __name__ == '__main__':
         encoderDisplay = Codex560(sys.argv[1], slaveaddress)
     except:
         ports=glob.glob("/dev/ttyUSB*")
-        encoderDisplay = None
-        for port in ports:
-            try:
-                print("- testing for codex560 with address {0} on {1}".format(slaveaddress,port))
-                encoderDisplay = Codex560(port, slaveaddress)
-                encoderDisplay.get_status()
-                print("Kübler CODEX-560 found on {0}".format(port))
-                break
-            except Exception as e:
-                encoderDisplay = None
+        print("- testing for codex560 with address {0} on {1}".format(slaveaddress,", ".join(ports)))
+        encoderDisplay = find_codex560(ports, slaveaddress)
+        if encoderDisplay is not None:
+            print("Kübler CODEX-560 found on {0}".format(encoderDisplay.serial.port))
 
         if encoderDisplay is None:
             redis_conn.set("depth-encoder", '{"depth": -9999, "velocity": -9999}')
@@ -1,4 +1,35 @@
 import math
+import itertools
+
+from operator import itemgetter
+
+import numpy as np
+
+
+# columns written with a fixed point format instead of %e, to keep sub-millisecond resolution
+CSV_FORMATS = {
+    "time_received": "%.6f",
+    "time_encoder": "%.6f",
+}
+
+
+CSV_CHUNK_LINES = 100000
+
+# angles that wrap around, as (low, high) of their range: -179.9 follows 179.9.
+# Averages and spreads of these are taken on the circle (see profiles, resample)
+PERIODIC_CHANNELS = {
+    "heading": (0.0, 360.0),
+    "roll": (-180.0, 180.0),
+    "azimuth": (0.0, 360.0),
+}
+
+
+def wrap(value, low, high):
+    """value (a float or numpy array) wrapped into [low, high)"""
+    return (value - low) % (high - low) + low
+
+STANDARD_GRAVITY = 9.80665  # m/s2
+TRANSDUCER_SPACING = 2.0  # m between the top and bottom ISDPT along the sonde
 
 
 class ParseException(Exception):
@@ -12,20 +43,6 @@ def verify_checksum(message):
     return message[-2:].lower() == f"{calc_cksum:02x}"
 
 
-def parse_hpr(message):
-    values = message[:-3].split(",")
-    if (len(values) < 4) or (not verify_checksum(message)):
-        return ["nan", "nan", "nan"]
-    return values[1:]
-
-
-def parse_dpt(message):
-    values = message[:-3].split(",")
-    if (len(values) < 7) or (not verify_checksum(message)):
-        return ["nan", "nan", "nan"]
-    return values[1:6:2]
-
-
 def robust_float(s):
     try:
         return float(s)
@@ -33,6 +50,194 @@ def robust_float(s):
         return math.nan
 
 
+# sensor sentences are in fields 5, 6 and 7 of a line. The position decides
+# the suffix of the channels: the depth sensors are ISDPT in both 6 (top)
+# and 7 (bottom)
+SENTENCE_SUFFIXES = ("", "_top", "_bottom")
+SENTENCE_FIRST_FIELD = 5
+
+
+class SentenceDecoder:
+    """Decodes one sensor sentence, e.g. "ISHPR,04.53,-4.40,-179.75 5D".
+
+    names are the channels it provides, indexes the positions of their values
+    in the comma separated sentence (after stripping the checksum). A decoder
+    without indexes marks a sensor that reports itself as not available
+    ("ODM N/A"); its channels stay nan.
+    """
+
+    def __init__(self, tag, names, indexes=(), suffixes=("",), checksum=True):
+        self.tag = tag
+        self.names = tuple(names)
+        self.suffixes = tuple(suffixes)
+        self.checksum = checksum
+        self.min_values = max(indexes) + 1 if indexes else 0
+        self.getter = itemgetter(*indexes) if len(indexes) > 1 else None
+        self.indexes = tuple(indexes)
+        # precompiled output keys per position suffix
+        self.keys = {suffix: tuple(name + suffix for name in self.names) for suffix in self.suffixes}
+
+    def decode(self, record, message, suffix):
+        keys = self.keys.get(suffix)
+        if keys is None or not self.indexes:
+            return
+        values = message[:-3].split(",")
+        if len(values) < self.min_values or (self.checksum and not verify_checksum(message)):
+            return
+        if self.getter is None:
+            values = (values[self.indexes[0]],)
+        else:
+            values = self.getter(values)
+        for key, value in zip(keys, values):
+            record[key] = robust_float(value)
+
+
+SENTENCE_DECODERS = {}
+
+# every channel any registered decoder can provide, nan unless decoded
+SENTENCE_DEFAULTS = {}
+
+
+def register_decoder(decoder):
+    SENTENCE_DECODERS[decoder.tag] = decoder
+    for keys in decoder.keys.values():
+        SENTENCE_DEFAULTS.update((key, math.nan) for key in keys)
+
+
+def sentence_tag(message):
+    end = len(message)
+    for sep in (",", " "):
+        i = message.find(sep, 0, end)
+        if i >= 0:
+            end = i
+    return message[:end]
+
+
+class DerivedChannel:
+    """A channel calculated from other channels, e.g. the pressure difference.
+
+    function takes the values of inputs (in that order) and only uses
+    arithmetic, so the same function works on one record's floats and on
+    numpy columns. Inputs may be derived channels themselves. label, unit,
+    format and enabled describe the readout in the GUI.
+    """
+
+    def __init__(self, name, inputs, function, label, unit="", format="%.2f", enabled=False):
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.function = function
+        self.label = label
+        self.unit = unit
+        self.format = format
+        self.enabled = enabled
+
+
+DERIVED_CHANNELS = {}
+
+# derived channel names in evaluation order (inputs before the channels using them)
+DERIVED_ORDER = []
+
+
+def register_derived(channel):
+    channels = dict(DERIVED_CHANNELS)
+    channels[channel.name] = channel
+    DERIVED_ORDER[:] = _dependency_order(channels)
+    DERIVED_CHANNELS[channel.name] = channel
+
+
+def _dependency_order(channels):
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order or name not in channels:
+            return
+        if name in visiting:
+            raise ValueError("derived channel %r is part of a dependency cycle" % name)
+        visiting.add(name)
+        for name_in in channels[name].inputs:
+            visit(name_in)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in channels:
+        visit(name)
+    return order
+
+
+def affected_channels(changed):
+    """Derived channels that depend, directly or not, on any of the changed channels, in evaluation order"""
+    affected = set(changed)
+    for name in DERIVED_ORDER:
+        if affected.intersection(DERIVED_CHANNELS[name].inputs):
+            affected.add(name)
+    return [name for name in DERIVED_ORDER if name in affected]
+
+
+def apply_offsets(values, offsets):
+    """Adds the offsets to the measured channels of a record (or columns of a log)"""
+    for name, offset in offsets.items():
+        if name in values and name not in DERIVED_CHANNELS:
+            values[name] = values[name] + offset
+    return values
+
+
+def apply_derived(record, names=None):
+    """Adds the derived channels (all, or names in evaluation order) to a record"""
+    for name in DERIVED_ORDER if names is None else names:
+        channel = DERIVED_CHANNELS[name]
+        record[name] = channel.function(*[record[n] for n in channel.inputs])
+    return record
+
+
+def derived_columns(columns, names=None):
+    """Derived channels of a log as numpy columns, e.g. to redo them after apply_offsets"""
+    values = dict(columns)
+    result = {}
+    for name in DERIVED_ORDER if names is None else names:
+        channel = DERIVED_CHANNELS[name]
+        inputs = [np.asarray(values[n], dtype=float) for n in channel.inputs]
+        values[name] = result[name] = channel.function(*inputs)
+    return result
+
+
+register_derived(
+    DerivedChannel(
+        "delta_pressure",
+        ("pressure_top", "pressure_bottom"),
+        lambda top, bottom: bottom - top,
+        "ΔP (bottom-top)", "B", "%.3f", True,
+    )
+)
+register_derived(
+    DerivedChannel(
+        "density",
+        ("delta_pressure",),
+        lambda dp: dp * 1e5 / (STANDARD_GRAVITY * TRANSDUCER_SPACING),
+        "Density (bottom-top)", "kg/m3", "%.1f",
+    )
+)
+register_derived(
+    DerivedChannel(
+        "temperature_gradient",
+        ("temperature_top", "temperature_bottom"),
+        lambda top, bottom: (bottom - top) / TRANSDUCER_SPACING,
+        "Temperature gradient", "C/m", "%.3f",
+    )
+)
+
+
+HPR_NAMES = ("heading", "pitch", "roll")
+DPT_NAMES = ("depth", "pressure", "temperature")
+
+register_decoder(SentenceDecoder("ISHPR", HPR_NAMES, (1, 2, 3)))
+register_decoder(SentenceDecoder("ISDPT", DPT_NAMES, (1, 3, 5), ("_top", "_bottom")))
+# sensors that are configured but not connected
+register_decoder(SentenceDecoder("ODM", HPR_NAMES))
+register_decoder(SentenceDecoder("ISD4000_1", DPT_NAMES, (), ("_top", "_bottom")))
+register_decoder(SentenceDecoder("ISD4000_2", DPT_NAMES, (), ("_top", "_bottom")))
+
+
 def parseRecord(line, offsets):
 
     line = str(line)
@@ -42,38 +247,72 @@ def parseRecord(line, offsets):
     if len(fields) < 8:
         raise ParseException("too few fields in line %d - %s" % (len(fields), line))
 
-    hpr = parse_hpr(fields[5])
-    dpt_top = parse_dpt(fields[6])
-    dpt_bottom = parse_dpt(fields[7])
-
     record = {
-        "record_number": fields[0],
-        "transducer_top": fields[1],
-        "transducer_bottom": fields[2],
-        "temperature_voltage": fields[3],
-        "button": fields[4],
-        "heading": hpr[0],
-        "pitch": hpr[1],
-        "roll": hpr[2],
-        "depth_top": dpt_top[0],
-        "pressure_top": dpt_top[1],
-        "temperature_top": dpt_top[2],
-        "depth_bottom": dpt_bottom[0],
-        "pressure_bottom": dpt_bottom[1],
-        "temperature_bottom": dpt_bottom[2],
+        "record_number": robust_float(fields[0]),
+        "transducer_top": robust_float(fields[1]),
+        "transducer_bottom": robust_float(fields[2]),
+        "temperature_voltage": robust_float(fields[3]),
+        "button": robust_float(fields[4]),
     }
+    record.update(SENTENCE_DEFAULTS)
 
-    # convert all to floats.
-    record.update((k, robust_float(v)) for k, v in record.items())
+    # decode the sensor sentences in one pass, dispatching on their tag
+    for suffix, message in zip(SENTENCE_SUFFIXES, fields[SENTENCE_FIRST_FIELD:]):
+        decoder = SENTENCE_DECODERS.get(sentence_tag(message))
+        if decoder is not None:
+            decoder.decode(record, message, suffix)
 
     # add room for external encoder read-out
     record["depth_winch"] = math.nan
 
-    # add calculated terms
+    # add room for the monotonic receive and encoder read times (time.perf_counter())
+    record["time_received"] = math.nan
+    record["time_encoder"] = math.nan
 
-    record["delta_pressure"] = record["pressure_bottom"] - record["pressure_top"]
+    # correct the measured channels, then add calculated terms from the corrected values
+    apply_offsets(record, offsets)
+    apply_derived(record)
 
     # TODO: apply calibrations to raw measurements.
 
 
     return record
+
+
+def csv_keys(record):
+    """Column order of the .csv output"""
+    return sorted(record.keys())
+
+
+def csv_header(keys):
+    return ",".join(['"%s"' % x for x in keys]) + "\n"
+
+
+def csv_line(record):
+    return ",".join([CSV_FORMATS.get(k, "%e") % record[k] for k in csv_keys(record)]) + "\n"
+
+
+def parse_csv_header(line):
+    return [n.strip().strip('"') for n in line.split(",")]
+
+
+def read_csv_chunks(filename, chunk_lines=CSV_CHUNK_LINES, usecols=None):
+    """Columns of a logger .csv (all, or the ones in usecols), chunk_lines rows at a time.
+
+    A last line without newline (still being written) is left out.
+    """
+    with open(filename) as f:
+        names = parse_csv_header(f.readline())
+        if usecols is not None:
+            indexes = [names.index(n) for n in usecols]
+            names = list(usecols)
+        else:
+            indexes = list(range(len(names)))
+        while True:
+            lines = list(itertools.islice(f, chunk_lines))
+            if lines and not lines[-1].endswith("\n"):
+                lines.pop()
+            if not lines:
+                return
+            data = np.loadtxt(lines, delimiter=",", ndmin=2, usecols=indexes)
+            yield {n: data[:, i] for i, n in enumerate(names)}
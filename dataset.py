@@ -0,0 +1,231 @@
+"""
+Campaign datasets: all recorded sessions in a directory as one table.
+
+A session is one savefilename set (.csv with .raw/.rawz/.txt/.log next to
+it). Dataset.discover finds them all; the dataset then behaves like one
+table that is concatenated lazily: a column is only read from the .csv
+files when it is accessed, and only from the sessions that are selected.
+
+    ds = dataset.Dataset.discover("/data/season2023")
+    deep = ds.select(depth_winch=(1500, 1600))
+    p = deep["pressure_bottom"]
+    which = deep.session_index()
+
+Every session has a summary (rows, min/max per column) cached in
+<session>.summary.json, so select() skips sessions that cannot match
+without reading their data. The cache is refreshed when the .csv changes.
+"""
+
+import os
+import re
+import json
+import glob
+
+import numpy as np
+
+import corrections
+
+FILE_SUFFIX_DATA = ".csv"
+FILE_SUFFIX_NOTES = ".txt"
+FILE_SUFFIX_SUMMARY = ".summary.json"
+
+SESSION_SUFFIXES = (".csv", ".raw", ".rawz", ".txt", ".log")
+
+# a .csv is only a session next to one of these; resample.py and
+# trajectory.py outputs, for example, have none
+COMPANION_SUFFIXES = (".raw", ".rawz", ".txt")
+
+OFFSET_NOTE = re.compile(r"\*\*\* auto \*\*\*: setting offset '(\w+)' to (\S+)")
+
+
+class Session:
+    def __init__(self, base):
+        self.base = base
+        self.name = os.path.basename(base)
+        self.columns = {}
+        self.columns_stamp = None  # stamp of the .csv the cached columns were read from
+
+    def __repr__(self):
+        return "Session(%r)" % self.base
+
+    @property
+    def datafile(self):
+        return self.base + FILE_SUFFIX_DATA
+
+    def files(self):
+        return [self.base + s for s in SESSION_SUFFIXES if os.path.isfile(self.base + s)]
+
+    def notes(self):
+        """[(record, text)] from the .txt notes file"""
+        notes = []
+        if os.path.isfile(self.base + FILE_SUFFIX_NOTES):
+            with open(self.base + FILE_SUFFIX_NOTES, encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    record, _, text = line.rstrip("\n").partition(": ")
+                    notes.append((record, text))
+        return notes
+
+    def offsets(self):
+        """Offsets set during the session, as recorded in the notes (last value wins)"""
+        offsets = {}
+        for _, text in self.notes():
+            match = OFFSET_NOTE.search(text)
+            if match:
+                offsets[match.group(1)] = float(match.group(2))
+        return offsets
+
+    def column_names(self):
+        if not os.path.isfile(self.datafile):
+            return []
+        with open(self.datafile) as f:
+            return corrections.parse_csv_header(f.readline())
+
+    def stamp(self):
+        """[size, mtime] of the .csv, changes while the session is still being recorded"""
+        stat = os.stat(self.datafile)
+        return [stat.st_size, stat.st_mtime]
+
+    def summary(self):
+        """{"rows": n, "ranges": {column: [min, max]}}, cached next to the .csv"""
+        if not os.path.isfile(self.datafile):
+            return {"rows": 0, "ranges": {}}
+        stamp = self.stamp()
+        cachefile = self.base + FILE_SUFFIX_SUMMARY
+        try:
+            with open(cachefile) as f:
+                cached = json.load(f)
+            if cached.get("stamp") == stamp:
+                return cached
+        except (OSError, ValueError):
+            pass
+
+        rows = 0
+        ranges = {}
+        for chunk in corrections.read_csv_chunks(self.datafile):
+            rows += len(next(iter(chunk.values())))
+            for name, values in chunk.items():
+                values = values[~np.isnan(values)]
+                if len(values) == 0:
+                    continue
+                lo, hi = float(values.min()), float(values.max())
+                if name in ranges:
+                    lo, hi = min(lo, ranges[name][0]), max(hi, ranges[name][1])
+                ranges[name] = [lo, hi]
+        summary = {"stamp": stamp, "rows": rows, "ranges": ranges}
+        try:
+            with open(cachefile, "w") as f:
+                json.dump(summary, f)
+        except OSError:
+            pass  # read-only archive, just do not cache
+        return summary
+
+    def start_record(self):
+        first = self.column("record_number")[:1]
+        return float(first[0]) if len(first) else None
+
+    def metadata(self):
+        summary = self.summary()
+        return {
+            "name": self.name,
+            "files": self.files(),
+            "rows": summary["rows"],
+            "start_record": self.start_record(),
+            "offsets": self.offsets(),
+            "notes": self.notes(),
+            "ranges": summary["ranges"],
+        }
+
+    def overlaps(self, ranges):
+        """False if the session cannot have rows within all of ranges {column: (lo, hi)}"""
+        known = self.summary()["ranges"]
+        for name, (lo, hi) in ranges.items():
+            if name not in known:
+                return False
+            smin, smax = known[name]
+            if smax < lo or smin > hi:
+                return False
+        return True
+
+    def column(self, name):
+        """One column of the .csv, read on first access and again when the .csv changed"""
+        stamp = self.stamp()
+        if stamp != self.columns_stamp:
+            self.columns = {}
+            self.columns_stamp = stamp
+        if name not in self.columns:
+            if name not in self.column_names():
+                raise KeyError("%s has no column %r" % (self.datafile, name))
+            chunks = [c[name] for c in corrections.read_csv_chunks(self.datafile, usecols=[name])]
+            self.columns[name] = np.concatenate(chunks) if chunks else np.empty(0)
+        return self.columns[name]
+
+    def mask(self, ranges):
+        mask = np.ones(self.summary()["rows"], dtype=bool)
+        for name, (lo, hi) in ranges.items():
+            values = self.column(name)
+            mask &= (values >= lo) & (values <= hi)
+        return mask
+
+
+class Dataset:
+    def __init__(self, sessions, ranges=None):
+        self.ranges = dict(ranges or {})
+        self.sessions = [s for s in sessions if s.overlaps(self.ranges)] if self.ranges else list(sessions)
+
+    @classmethod
+    def discover(cls, directory):
+        """All sessions in directory that have a .csv and a .raw/.rawz/.txt, in name order"""
+        bases = set()
+        for filename in glob.glob(os.path.join(directory, "*" + FILE_SUFFIX_DATA)):
+            base = filename[: -len(FILE_SUFFIX_DATA)]
+            if any(os.path.isfile(base + s) for s in COMPANION_SUFFIXES):
+                bases.add(base)
+        return cls([Session(b) for b in sorted(bases)])
+
+    def __repr__(self):
+        return "Dataset(%d sessions, %d rows)" % (len(self.sessions), len(self))
+
+    def select(self, **ranges):
+        """Rows with every given column within (lo, hi), e.g. select(depth_winch=(100, 200))"""
+        merged = dict(self.ranges)
+        for name, (lo, hi) in ranges.items():
+            if name in merged:
+                lo, hi = max(lo, merged[name][0]), min(hi, merged[name][1])
+            merged[name] = (lo, hi)
+        return Dataset(self.sessions, merged)
+
+    def _masks(self):
+        return [s.mask(self.ranges) if self.ranges else None for s in self.sessions]
+
+    def __len__(self):
+        if not self.ranges:
+            return sum(s.summary()["rows"] for s in self.sessions)
+        return int(sum(m.sum() for m in self._masks()))
+
+    def __getitem__(self, name):
+        parts = []
+        for session, mask in zip(self.sessions, self._masks()):
+            if name in session.column_names():
+                values = session.column(name)
+            else:
+                # e.g. older recordings without a channel
+                values = np.full(session.summary()["rows"], np.nan)
+            parts.append(values if mask is None else values[mask])
+        return np.concatenate(parts) if parts else np.empty(0)
+
+    def columns(self):
+        names = []
+        for session in self.sessions:
+            names += [n for n in session.column_names() if n not in names]
+        return names
+
+    def session_index(self):
+        """Index into self.sessions of every row"""
+        parts = []
+        for k, (session, mask) in enumerate(zip(self.sessions, self._masks())):
+            n = session.summary()["rows"] if mask is None else int(mask.sum())
+            parts.append(np.full(n, k))
+        return np.concatenate(parts) if parts else np.empty(0, dtype=int)
+
+    def metadata(self):
+        return [s.metadata() for s in self.sessions]
@@ -0,0 +1,78 @@
+"""
+Level of detail for long plotted series.
+
+MinMaxDecimator keeps a series of any length as at most `max_buckets`
+buckets of consecutive samples, storing the minimum and maximum of each
+bucket (with the x value where they occurred). Plotting the min and max
+of every bucket in sample order draws the same envelope as the full series
+when there is about one bucket per pixel. When the buckets run out,
+neighbouring buckets are merged pairwise and the bucket size doubles, so
+appending is amortized O(1) and memory stays bounded.
+"""
+
+import math
+
+
+class MinMaxDecimator:
+    def __init__(self, max_buckets=1000):
+        self.max_buckets = max_buckets
+        self.clear()
+
+    def clear(self):
+        self.bucket_size = 1
+        self.count = 0
+        # full buckets: [imin, xmin, vmin, imax, xmax, vmax]
+        self.buckets = []
+        self.current = None
+        self.current_size = 0
+
+    def append(self, x, value):
+        if math.isnan(x) or math.isnan(value):
+            return
+        i = self.count
+        self.count += 1
+        c = self.current
+        if c is None:
+            self.current = [i, x, value, i, x, value]
+        else:
+            if value < c[2]:
+                c[0], c[1], c[2] = i, x, value
+            if value > c[5]:
+                c[3], c[4], c[5] = i, x, value
+        self.current_size += 1
+
+        if self.current_size >= self.bucket_size:
+            self.buckets.append(self.current)
+            self.current = None
+            self.current_size = 0
+            if len(self.buckets) >= self.max_buckets:
+                self._merge()
+
+    def _merge(self):
+        merged = []
+        for k in range(0, len(self.buckets) - 1, 2):
+            a, b = self.buckets[k], self.buckets[k + 1]
+            lo = a if a[2] <= b[2] else b
+            hi = a if a[5] >= b[5] else b
+            merged.append([lo[0], lo[1], lo[2], hi[3], hi[4], hi[5]])
+        if len(self.buckets) % 2:
+            merged.append(self.buckets[-1])
+        self.buckets = merged
+        self.bucket_size *= 2
+
+    def points(self):
+        """(xs, values) of the decimated series, in sample order"""
+        xs = []
+        values = []
+        buckets = self.buckets if self.current is None else self.buckets + [self.current]
+        for imin, xmin, vmin, imax, xmax, vmax in buckets:
+            if imin == imax:
+                xs.append(xmin)
+                values.append(vmin)
+            elif imin < imax:
+                xs += [xmin, xmax]
+                values += [vmin, vmax]
+            else:
+                xs += [xmax, xmin]
+                values += [vmax, vmin]
+        return xs, values
@@ -8,6 +8,9 @@ import os.path
 import sys
 import datetime
 import math
+import time
+import cProfile
+import pstats
 
 import pylab
 
@@ -17,20 +20,50 @@ from PyQt5 import QtWidgets, QtGui, QtCore
 from io import StringIO
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+from matplotlib.figure import Figure
 
 import workers
 import corrections
 import utilities
-from codex560 import Codex560
+import profiles
+import lod
+import rawarchive
+import quality
+import trajectory
+import warmstart
+from codex560 import Codex560, find_codex560
 
 MAX_HISTORY = 60  # how many points are saved, 60 = 3 minutes
+MAX_CONSOLE_LINES = 5000  # older console lines are dropped (the .log file keeps everything)
 Y_OFFSET = 0.1  # offset from sides in plot
 Y_SCALE = 0.1  # maximum graph scale
 
 FILE_SUFFIX_RAW = ".raw"
+FILE_SUFFIX_RAWZ = rawarchive.FILE_SUFFIX_ARCHIVE
 FILE_SUFFIX_LOG = ".log"
 FILE_SUFFIX_DATA = ".csv"
 FILE_SUFFIX_NOTES = ".txt"
+FILE_SUFFIX_PROFILE = ".profile.csv"
+FILE_SUFFIX_PROFILER = ".prof"
+
+PROFILER_TOP = 15  # functions listed in the console when profiling stops
+
+PROFILE_BIN_SIZE = 1.0  # m, depth bins of the recorded profile
+DEPTH_PLOT_BUCKETS = 1000  # min/max buckets per channel in the depth plot, ~ one per pixel row
+DEPTH_PLOT_INTERVAL = 500  # ms between redraws of the depth plot
+# background of a readout per data quality state
+QUALITY_COLORS = {
+    quality.OK: "none",
+    quality.SPIKE: "orange",
+    quality.FLATLINE: "khaki",
+    quality.DROPOUT: "lightcoral",
+}
+
+DISPLAY_INTERVAL = 40  # ms, readouts and the tracked plot are redrawn at most this often
+INPUT_BATCH = 200  # most lines handled per GUI event, so the GUI stays responsive when behind
+
+LAG_WARNING = 1.0  # s, receive -> displayed lag shown in orange
+LAG_ALARM = 5.0  # s, receive -> displayed lag shown in red and reported in the console
 
 
 def input(q="question"):
@@ -134,6 +167,7 @@ class OffsetsDialog(QtWidgets.QDialog):
         layout.addWidget(buttons)
 
     def accept(self):
+        changed = {}  # offset name: change
         for ref in self.refs:
 
             if ref.endswith("_raw"):
@@ -141,13 +175,16 @@ class OffsetsDialog(QtWidgets.QDialog):
             else:
                 value = float(str(self.refs[ref].text()))
 
-            if abs(value) > 1e-10:
+            previous = self.parentWidget.offsets[ref]
+            if value != previous:
                 print("Offset: setting %s to %f" % (ref, value))
                 self.parentWidget.addNote(
                     "*** auto ***: setting offset '%s' to %f" % (ref, value)
                 )
                 self.parentWidget.offsets[ref] = value
+                changed[ref] = value - previous
 
+        self.parentWidget.offsetsChanged(changed)
         super(OffsetsDialog, self).accept()
 
 
@@ -160,6 +197,8 @@ class ValueDisplay(QtWidgets.QFrame):
         self.unit = unit
         self.format = format + " %s"
         self.value = '-'
+        self.text = None  # text currently shown, to skip unchanged updates
+        self.quality = quality.OK
         self.history = deque(
             maxlen=MAX_HISTORY
         )  # automatically pops elements when MAX_HISTORY is reached
@@ -179,6 +218,7 @@ class ValueDisplay(QtWidgets.QFrame):
         layout.addWidget(self.labelWidget)
         layout.addWidget(self.valueWidget)
         self.setLayout(layout)
+        self.value = math.nan
         self.setEnabled(enabled)
         self.set(math.nan)
 
@@ -189,24 +229,44 @@ class ValueDisplay(QtWidgets.QFrame):
     def setEnabled(self, enabled):
         self.enabled = enabled
         self.setVisible(self.enabled)
+        self.render()
 
     def set(self, value):
+        self.capture(value)
+        self.render()
+        self.plot()
+
+    def capture(self, value):
+        # keep the value and its history, without touching the widgets
         self.value = value
         self.history.append(value)
-        if math.isnan(value):
-            self.valueWidget.setText("n/a")
+
+    def render(self):
+        # update the shown value, if visible and changed
+        if not self.enabled:
+            return
+        if math.isnan(self.value):
+            text = "n/a"
         else:
-            self.valueWidget.setText(self.format % (self.value, self.unit))
-        self.plot()
+            text = self.format % (self.value, self.unit)
+        if text != self.text:
+            self.text = text
+            self.valueWidget.setText(text)
 
     def setActive(self):
         print("Plot: Tracking parameter", self.label)
         if self.parentWidget.activePlot is not None:
             self.parentWidget.activePlot.setLineWidth(0)
         self.setLineWidth(1)
-        self.setStyleSheet("background-color: none")
+        self.setQuality(self.quality)
         self.parentWidget.activePlot = self
         self.plot()
+        if self.parentWidget.depthPlot is not None:
+            self.parentWidget.depthPlot.dirty = True
+
+    def setQuality(self, state):
+        self.quality = state
+        self.setStyleSheet("background-color: %s" % QUALITY_COLORS[state])
 
     def plot(self):
         if self.parentWidget.activePlot is self:
@@ -217,7 +277,65 @@ class ValueDisplay(QtWidgets.QFrame):
                 ymin = pylab.floor(pylab.nanmin(data) / Y_SCALE) * Y_SCALE
                 ymax = pylab.ceil(pylab.nanmax(data) / Y_SCALE) * Y_SCALE
                 pylab.ylim(ymin - Y_OFFSET, ymax + Y_OFFSET)
-            self.parentWidget.canvas.draw()
+            self.parentWidget.canvas.draw_idle()
+
+
+class DepthPlot:
+    """Tracked parameter against winch depth for the whole run.
+
+    Every channel is kept min/max decimated (see lod.py), so appending a
+    record is cheap and a redraw only ever draws ~2*DEPTH_PLOT_BUCKETS points.
+    Redraws are throttled to one per DEPTH_PLOT_INTERVAL.
+    """
+
+    def __init__(self, parentWidget, channels):
+        self.parentWidget = parentWidget
+        self.series = {c: lod.MinMaxDecimator(DEPTH_PLOT_BUCKETS) for c in channels}
+        self.dirty = False
+
+        # own figure, so the pylab state of the main plot is not touched
+        self.figure = Figure()
+        self.canvas = FigureCanvas(self.figure)
+        self.axes = self.figure.add_subplot(111)
+        self.axes.set_ylabel("Depth winch (m)")
+        self.axes.invert_yaxis()
+        self.axes.grid(True)
+        self.axes.xaxis.set_major_formatter(pylab.mpl.ticker.ScalarFormatter(useOffset=False))
+        self.line = self.axes.plot([], [], "-", color=(0.8, 0, 0, 1), linewidth=1)[0]
+        self.figure.tight_layout()
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.draw)
+        self.timer.start(DEPTH_PLOT_INTERVAL)
+
+    def clear(self):
+        for series in self.series.values():
+            series.clear()
+        self.dirty = True
+
+    def add(self, record):
+        depth = record["depth_winch"]
+        if math.isnan(depth):
+            return
+        for channel, series in self.series.items():
+            series.append(depth, record[channel])
+        self.dirty = True
+
+    def draw(self):
+        active = self.parentWidget.activePlot
+        if not self.dirty or active is None:
+            return
+        self.dirty = False
+        channel = next((k for k, v in self.parentWidget.readouts.items() if v is active), None)
+        if channel not in self.series:
+            return
+        depths, values = self.series[channel].points()
+        self.line.set_data(values, depths)
+        self.axes.set_xlabel(active.label)
+        if depths:
+            self.axes.set_xlim(min(values) - Y_OFFSET, max(values) + Y_OFFSET)
+            self.axes.set_ylim(max(depths) + Y_OFFSET, min(depths) - Y_OFFSET)
+        self.canvas.draw_idle()
 
 
 class MainWindow(QtWidgets.QMainWindow):
@@ -228,9 +346,19 @@ class MainWindow(QtWidgets.QMainWindow):
         # "globals"
         self.recording = False
         self.savefilename = None
-        self.inputworker = None
         self.last_record = "####"
         self.encoder = None
+        self.loggerPort = None
+        self.encoderDepth = math.nan
+        self.encoderTime = math.nan
+        self.compressRaw = False
+        self.rawArchive = None
+        self.lag = 0.0
+        self.lagAlarm = False
+        self.profiler = None
+        self.renderPending = False
+        self.latestRecord = None
+        self.coalesced = 0  # records whose display was superseded by a newer one
 
         # widgets
         self.figure = pylab.figure()
@@ -239,6 +367,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
         y_formatter = pylab.mpl.ticker.ScalarFormatter(useOffset=False)
         self.activePlot = None
+        self.depthPlot = None
         self.plot = pylab.plot([0,60], [0,1], "r.-", markersize=18, clip_on=False)[0]
         self.plot.set_markerfacecolor((0.8, 0, 0, 1))
         self.plot.set_color((0.8, 0, 0, 0.1))
@@ -269,12 +398,34 @@ class MainWindow(QtWidgets.QMainWindow):
                 ("depth_bottom", ValueDisplay(self, "AtmDepth (bottom)", "m", "%.2f")),
                 ("pressure_bottom", ValueDisplay(self, "Pressure (bottom)", "B", "%.2f", True)),
                 ("temperature_bottom", ValueDisplay(self, "Temperature (bottom)", "C", "%.2f", True)),
-                # ---- Calculated values ----
-                ("delta_pressure", ValueDisplay(self, "ΔP (bottom-top)", "B", "%.3f", True)),
             ]
         )
+        # ---- Calculated values, as declared in corrections ----
+        for name in corrections.DERIVED_ORDER:
+            channel = corrections.DERIVED_CHANNELS[name]
+            self.readouts[name] = ValueDisplay(self, channel.label, channel.unit, channel.format, channel.enabled)
+        self.readouts.update(
+            [
+                ("inclination", ValueDisplay(self, "Inclination", "deg", "%.2f")),
+                ("azimuth", ValueDisplay(self, "Azimuth", "deg", "%.1f")),
+                ("trajectory_x", ValueDisplay(self, "Trajectory East", "m", "%.2f")),
+                ("trajectory_y", ValueDisplay(self, "Trajectory North", "m", "%.2f")),
+                ("trajectory_z", ValueDisplay(self, "Trajectory TVD", "m", "%.2f")),
+            ]
+        )
+        self.depthPlot = DepthPlot(self, [r for r in self.readouts if r != "depth_winch"])
+        self.quality = quality.QualityMonitor([r for r in self.readouts if r != "record_number"])
         self.readouts["pressure_top"].setActive()
 
+        # borehole path from heading/pitch/roll and the winch depth, restarted with every savefile
+        self.trajectory = trajectory.Trajectory()
+
+        # depth binned profile of the recording, kept separate for down and up runs
+        self.profile = profiles.DepthProfile(
+            [r for r in self.readouts if r not in ("record_number", "depth_winch")],
+            PROFILE_BIN_SIZE,
+        )
+
         self.offsets = OrderedDict(
             [
                 ("depth_top", 0.0),
@@ -293,6 +444,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.console.setFont(QtGui.QFont("mono", 10))
         self.setConsoleColor("black")
         self.console.setFixedHeight(150)
+        self.console.document().setMaximumBlockCount(MAX_CONSOLE_LINES)
 
         # redirect streams to console
         self.streams = sys.stdin, sys.stdout, sys.stderr
@@ -308,12 +460,28 @@ class MainWindow(QtWidgets.QMainWindow):
         graphbox.addWidget(self.canvas)
         # graphbox.addWidget(self.toolbar)
         topbox = QtWidgets.QHBoxLayout()
-        topbox.addLayout(graphbox)
+        topbox.addLayout(graphbox, 2)
+        topbox.addWidget(self.depthPlot.canvas, 1)
         topbox.addLayout(self.valuebox)
         box = QtWidgets.QVBoxLayout()
         box.addLayout(topbox)
         box.addWidget(self.console)
 
+        # receive -> displayed lag of the latest record
+        self.lagLabel = QtWidgets.QLabel("Lag: n/a")
+        self.lagLabel.setFont(QtGui.QFont("mono", 10))
+        self.statusBar().addPermanentWidget(self.lagLabel)
+        self.queueLabel = QtWidgets.QLabel("")
+        self.queueLabel.setFont(QtGui.QFont("mono", 10))
+        self.statusBar().addPermanentWidget(self.queueLabel)
+
+        # all input sources run in the acquisition core
+        self.acquisition = workers.AcquisitionCore()
+        self.acquisition.ready_signal.connect(self.drainInput)
+        self.acquisition.depth_signal.connect(self.newDepth)
+        self.acquisition.message_signal.connect(print)
+        self.acquisition.start()
+
         # menubar
         self.menubar = self.menuBar()
         self.fileMenu = self.menubar.addMenu("&File")
@@ -328,6 +496,9 @@ class MainWindow(QtWidgets.QMainWindow):
         connectSerialAction.setShortcut("Ctrl+O")
         connectSerialAction.triggered.connect(self.connectSerial)
 
+        connectNetworkAction = QtWidgets.QAction("Connect: Network (TCP)...", self)
+        connectNetworkAction.triggered.connect(self.connectNetwork)
+
         connectFileAction = QtWidgets.QAction("Connect: File (Replay)...", self)
         connectFileAction.setShortcut("Ctrl+I")
         connectFileAction.triggered.connect(self.connectFile)
@@ -340,6 +511,8 @@ class MainWindow(QtWidgets.QMainWindow):
         saveFileAction.triggered.connect(self.setSaveFile)
         saveCloseFileAction = QtWidgets.QAction("Close Save File", self)
         saveCloseFileAction.triggered.connect(self.closeSaveFile)
+        warmStartAction = QtWidgets.QAction("Warm Start from Save File...", self)
+        warmStartAction.triggered.connect(self.warmStart)
 
         exitAction = QtWidgets.QAction("Exit", self)
         exitAction.setShortcut("Ctrl+Q")
@@ -347,17 +520,19 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.fileMenu.addAction(connectSerialAction)
         self.fileMenu.addAction(connectEncoderAction)
+        self.fileMenu.addAction(connectNetworkAction)
         self.fileMenu.addAction(connectFileAction)
         self.fileMenu.addAction(disconnectAction)
         self.fileMenu.addSeparator()
         self.fileMenu.addAction(saveFileAction)
         self.fileMenu.addAction(saveCloseFileAction)
+        self.fileMenu.addAction(warmStartAction)
         self.fileMenu.addSeparator()
         self.fileMenu.addAction(exitAction)
 
-        toggleRecordingAction = QtWidgets.QAction("Record", self, checkable=True)
-        toggleRecordingAction.setShortcut("Ctrl+R")
-        toggleRecordingAction.triggered.connect(self.toggleRecording)
+        self.toggleRecordingAction = QtWidgets.QAction("Record", self, checkable=True)
+        self.toggleRecordingAction.setShortcut("Ctrl+R")
+        self.toggleRecordingAction.triggered.connect(self.toggleRecording)
 
         addNoteAction = QtWidgets.QAction("Add note...", self)
         addNoteAction.setShortcut("Ctrl+N")
@@ -369,12 +544,25 @@ class MainWindow(QtWidgets.QMainWindow):
         offsetsAction = QtWidgets.QAction("Offsets...", self)
         offsetsAction.triggered.connect(self.showOffsets)
 
-        self.actionMenu.addAction(toggleRecordingAction)
+        profileAction = QtWidgets.QAction("Profile", self, checkable=True)
+        profileAction.triggered.connect(self.toggleProfiler)
+
+        self.compressRawAction = QtWidgets.QAction("Compress raw data (%s)" % FILE_SUFFIX_RAWZ, self, checkable=True)
+        self.compressRawAction.triggered.connect(self.toggleCompressRaw)
+
+        clearDepthPlotAction = QtWidgets.QAction("Clear depth plot", self)
+        clearDepthPlotAction.triggered.connect(self.depthPlot.clear)
+
+        self.actionMenu.addAction(self.toggleRecordingAction)
         self.actionMenu.addSeparator()
         self.actionMenu.addAction(addNoteAction)
         self.actionMenu.addSeparator()
         self.actionMenu.addAction(optionsAction)
         self.actionMenu.addAction(offsetsAction)
+        self.actionMenu.addAction(self.compressRawAction)
+        self.actionMenu.addSeparator()
+        self.actionMenu.addAction(clearDepthPlotAction)
+        self.actionMenu.addAction(profileAction)
 
         # value widgets
         for idx, readout in enumerate(self.readouts):
@@ -410,16 +598,30 @@ class MainWindow(QtWidgets.QMainWindow):
         ports = utilities.enumerate_serial()
         print("Encoder: Detected the %d serial ports on the system" % len(ports))
         if len(ports):
-            print("Found:", ", ".join(ports))
+            print("Found:", ", ".join(utilities.label_serial(ports)))
 
         try:
-            port = input("Enter port name: ")
+            port = input("Enter port name (empty to autodetect): ").strip()
         except EOFError:
             print("Encoder: User cancelled")
             return
 
+        if port == "":
+            # never probe the logger's own port, the modbus frames would garble its stream
+            if self.loggerPort is not None and self.acquisition.has_source("logger"):
+                logger = os.path.realpath(self.loggerPort.strip())
+                ports = [p for p in ports if os.path.realpath(p) != logger]
+            self.encoder = find_codex560(ports, 1)
+            if self.encoder is None:
+                print("Encoder: No Codex560 found")
+                return
+            port = self.encoder.serial.port
+        else:
+            self.encoder = Codex560(port, 1)
+
         print("Encoder: Using port:", port)
-        self.encoder = Codex560(port, 1)
+        self.encoderDepth = math.nan
+        self.acquisition.add_source("encoder", workers.encoder_source(self.acquisition, self.encoder))
 
         print("Encoder: Connected")
 
@@ -428,7 +630,7 @@ class MainWindow(QtWidgets.QMainWindow):
         ports = utilities.enumerate_serial()
         print("Serial: Detected the %d serial ports on the system" % len(ports))
         if len(ports):
-            print("Found:", ", ".join(ports))
+            print("Found:", ", ".join(utilities.label_serial(ports)))
 
         try:
             port = input("Enter port name: ")
@@ -438,9 +640,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
         print("Serial: Using port:", port)
 
-        worker = workers.SerialInputWorker(port)
-        self.setInputWorker(worker)
-        worker.start()
+        self.setInputSource(workers.serial_source(self.acquisition, workers.open_logger_serial(port)), port)
 
         print("Serial: Connected")
 
@@ -459,12 +659,26 @@ class MainWindow(QtWidgets.QMainWindow):
             print("File input: User cancelled")
             return
 
-        worker = workers.FileInputWorker(filename, delay)
-        self.setInputWorker(worker)
-        worker.start()
+        self.setInputSource(workers.file_source(self.acquisition, filename, delay))
 
         print("File input: Connected.")
 
+    def connectNetwork(self):
+        try:
+            address = input("Network: host:port: ").strip()
+        except EOFError:
+            print("Network: User cancelled")
+            return
+
+        host, _, port = address.rpartition(":")
+        if host == "" or not port.isdigit():
+            print("Network: Expected host:port, got", address)
+            return
+
+        self.setInputSource(workers.tcp_source(self.acquisition, host, int(port)))
+
+        print("Network: Connecting to", address)
+
     def setSaveFile(self):
 
         filename = str(QtWidgets.QFileDialog.getSaveFileName()[0])
@@ -481,6 +695,12 @@ class MainWindow(QtWidgets.QMainWindow):
                 filename + FILE_SUFFIX_RAW,
             )
 
+        if os.path.isfile(filename + FILE_SUFFIX_RAWZ):
+            print(
+                "File save WARNING: compressed raw data file already exists at",
+                filename + FILE_SUFFIX_RAWZ,
+            )
+
         if os.path.isfile(filename + FILE_SUFFIX_LOG):
             print(
                 "File save WARNING: log data file already exists at",
@@ -500,6 +720,10 @@ class MainWindow(QtWidgets.QMainWindow):
             )
 
         self.savefilename = filename
+        self.profile.reset()
+        self.trajectory.reset()
+        self.resetQuality()
+        self.depthPlot.clear()
 
     def toggleRecording(self):
         self.recording = not self.recording
@@ -507,12 +731,13 @@ class MainWindow(QtWidgets.QMainWindow):
 
         for action in self.fileMenu.actions():
             action.setEnabled(not self.recording)
+        self.compressRawAction.setEnabled(not self.recording)
 
         if self.recording:
 
             hasErrors = False
 
-            if self.inputworker is None:
+            if not self.acquisition.has_source("logger"):
                 print(
                     "Recording WARNING: no input source is selected, nothing will be recorded"
                 )
@@ -529,8 +754,128 @@ class MainWindow(QtWidgets.QMainWindow):
             else:
                 self.setConsoleColor("darkgreen")
 
+            if self.savefilename is not None:
+                # reference to relate the monotonic time_* columns to wall clock time
+                self.addNote(
+                    "*** auto ***: monotonic clock %.6f at %s"
+                    % (time.perf_counter(), datetime.datetime.now().isoformat())
+                )
+
+            if self.compressRaw and self.savefilename is not None:
+                self.rawArchive = rawarchive.RawArchiveWriter(self.savefilename + FILE_SUFFIX_RAWZ)
+
         else:
             self.setConsoleColor("black")
+            if self.rawArchive is not None:
+                self.rawArchive.close()
+                self.rawArchive = None
+            if self.savefilename is not None:
+                self.profile.save(self.savefilename + FILE_SUFFIX_PROFILE)
+                print("Profile: saved to", self.savefilename + FILE_SUFFIX_PROFILE)
+
+    def toggleProfiler(self):
+        # cProfile only sees the thread it is enabled in; that is the GUI thread,
+        # where parsing, saving, quality checks and plotting run
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            print("Profile: Started")
+            return
+
+        self.profiler.disable()
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        if self.savefilename is not None:
+            filename = "%s-%s%s" % (self.savefilename, stamp, FILE_SUFFIX_PROFILER)
+        else:
+            filename = os.path.abspath("logger-%s%s" % (stamp, FILE_SUFFIX_PROFILER))
+        self.profiler.dump_stats(filename)
+
+        report = StringIO()
+        stats = pstats.Stats(self.profiler, stream=report)
+        stats.strip_dirs().sort_stats("cumulative").print_stats(PROFILER_TOP)
+        self.profiler = None
+        print(report.getvalue().strip())
+        print("Profile: Stopped, saved to", filename)
+
+    def warmStart(self):
+        # continue an interrupted run: reload the end of its recording and keep recording into it
+        filename = str(QtWidgets.QFileDialog.getOpenFileName()[0])
+
+        if filename == "":
+            print("Warm start: No file chosen, try again.")
+            return
+
+        base = warmstart.recording_base(filename)
+        started = time.perf_counter()
+        records, source = warmstart.load_tail(base, MAX_HISTORY, self.offsets)
+        if not records:
+            print("Warm start: no records found for", base)
+            return
+
+        self.depthPlot.clear()
+        self.resetQuality()
+        for readout in self.readouts.values():
+            readout.history.clear()
+        for record in records:
+            full = dict.fromkeys(self.readouts, math.nan)
+            full.update(record)
+            for name, readout in self.readouts.items():
+                readout.capture(full[name])
+            self.depthPlot.add(full)
+        self.last_record = records[-1]["record_number"]
+        self.trajectory.reset()
+        # the last record with depth and position, an encoder glitch may have left the very last without
+        if not any(self.trajectory.resume(record) for record in reversed(records)):
+            print("Warm start WARNING: no record with depth and trajectory, the trajectory restarts at 0")
+        # time_received is from the clock of the previous run, so no lag is computed from it
+        self.latestRecord = None
+        for readout in self.readouts.values():
+            readout.render()
+        if self.activePlot is not None:
+            self.activePlot.plot()
+        print(
+            "Warm start: %d records up to record %.0f from %s in %.1f ms"
+            % (len(records), self.last_record, source, (time.perf_counter() - started) * 1000)
+        )
+
+        columns = warmstart.csv_columns(base + FILE_SUFFIX_DATA)
+        expected = corrections.csv_keys(dict.fromkeys(list(self.readouts) + ["time_received", "time_encoder"]))
+        if columns is not None and columns != expected:
+            print(
+                "Warm start WARNING: the columns of",
+                base + FILE_SUFFIX_DATA,
+                "differ from what is recorded now, set a new save file before recording",
+            )
+            return
+
+        # a line cut off by the crash would be glued to the next record or note
+        for suffix in (FILE_SUFFIX_DATA, FILE_SUFFIX_RAW, FILE_SUFFIX_NOTES):
+            removed = warmstart.truncate_partial_line(base + suffix)
+            if removed:
+                print("Warm start: removed an incomplete last line (%d bytes) from %s" % (removed, base + suffix))
+
+        self.savefilename = base
+        self.profile.reset()
+        compressRaw = os.path.isfile(base + FILE_SUFFIX_RAWZ) and not os.path.isfile(base + FILE_SUFFIX_RAW)
+        if compressRaw != self.compressRaw:
+            self.compressRawAction.setChecked(compressRaw)
+            self.toggleCompressRaw()
+        print("Save file: continuing", base)
+
+        self.addNote("*** auto ***: warm start after record %.0f" % self.last_record)
+        if self.acquisition.has_source("logger"):
+            if not self.recording:
+                self.toggleRecordingAction.setChecked(True)
+                self.toggleRecording()
+        else:
+            print("Warm start: connect the input and start recording to continue the run")
+
+    def toggleCompressRaw(self):
+        self.compressRaw = not self.compressRaw
+        print(
+            "Recording: raw data is saved to",
+            FILE_SUFFIX_RAWZ + " (compressed)" if self.compressRaw else FILE_SUFFIX_RAW,
+        )
 
     def addNote(self, note=None):
         if self.savefilename is not None:
@@ -552,75 +897,183 @@ class MainWindow(QtWidgets.QMainWindow):
         od = OffsetsDialog(self)
         od.exec_()
 
-    def newData(self, line):
-        # new data comes in from either source (serial or file)
-        # as a line in the custom encoding format
+    def offsetsChanged(self, changed):
+        # new records get the offsets when parsed; the shown record only needs the
+        # changed channels corrected by the change and the derived channels that depend on them
+        record = self.latestRecord
+        if record is None:
+            return
+        corrections.apply_offsets(record, changed)
+        affected = corrections.affected_channels(changed)
+        corrections.apply_derived(record, affected)
+        for name in [n for n in changed if n in record] + affected:
+            readout = self.readouts[name]
+            readout.value = record[name]
+            if readout.history:
+                readout.history[-1] = record[name]
+            readout.render()
+            readout.plot()
+
+    def drainInput(self):
+        # every queued line is saved and parsed; the display shows the latest
+        # record, at most once per DISPLAY_INTERVAL
+        items = self.acquisition.take_lines(INPUT_BATCH)
+        latest = None
+        for line, received in items:
+            try:
+                record = self.processLine(line, received)
+            except corrections.ParseException as e:
+                # the line is in the raw backup already; the rest of the batch goes on
+                print("Parse: skipped line:", e)
+                continue
+            except Exception as e:
+                # a failing line must not lose the rest of the batch, which is off the queue already
+                print("Input: failed on line %r: %s" % (line, str(e) or type(e).__name__))
+                continue
+            if record is not None:
+                if latest is not None:
+                    self.coalesced += 1
+                latest = record
+
+        if latest is not None:
+            self.updateLag(time.perf_counter() - latest["time_received"])
+            self.displayRecord(latest)
+        self.queueLabel.setText(
+            "Queue: %d  queued %d  coalesced %d"
+            % (self.acquisition.backlog(), self.acquisition.queued, self.coalesced)
+        )
+
+        if self.acquisition.backlog():
+            QtCore.QTimer.singleShot(0, self.drainInput)
+
+    def processLine(self, line, received=None):
+        # save, parse and record one line. Returns the record, None for empty lines
 
         if line == "":
             # IGNORE EMPTY LINES...
             # print("WARNING: End of data stream")
             # self.disconnect()
-            return
+            return None
 
         # first: save a backup, if savefile is selected and recording
-        if self.recording and self.savefilename is not None:
+        if self.rawArchive is not None:
+            self.rawArchive.write(line)
+        elif self.recording and self.savefilename is not None:
             with open(self.savefilename + FILE_SUFFIX_RAW, "a") as rawfile:
                 rawfile.write(line + "\n")
 
         # second: convert the line into dict, using the data parser and apply offsets
         record = corrections.parseRecord(line, self.offsets)
+        record["time_received"] = time.perf_counter() if received is None else received
 
-        # second and a half: get the current depth and add it to the record
+        # second and a half: add the latest depth polled from the encoder
         if (self.encoder):
-            try:
-                record['depth_winch'] = float(self.encoder.get_main_counter()) * (-1.0)
-            except:
-                pass
+            record['depth_winch'] = self.encoderDepth * (-1.0)
+            record['time_encoder'] = self.encoderTime
+
+        # derived: inclination, azimuth and the minimum curvature position
+        record.update(self.trajectory.add(record))
+
+        # second and three quarters: check for spikes, flatlines and dropouts
+        self.checkQuality(record)
 
         # third: save the coverted data, if savefile is selected and recording
         if self.recording and self.savefilename is not None:
             with open(self.savefilename + FILE_SUFFIX_DATA, "a") as datafile:
-                record = OrderedDict(sorted(record.items()))
-
                 # if datafile is empty, add header
                 if os.fstat(datafile.fileno()).st_size == 0:
                     print("Save: New datafile, adding header")
-                    keys = ",".join(['"%s"' % x for x in list(record.keys())])
-                    datafile.write(keys + "\n")
+                    datafile.write(corrections.csv_header(corrections.csv_keys(record)))
+
+                datafile.write(corrections.csv_line(record))
 
-                values = ",".join(["%e" % x for x in list(record.values())])
-                datafile.write(values + "\n")
+            self.profile.add(record)
 
-        # fourth: update display
+        # the history of the readouts and the depth plot cover every record
         for readout in self.readouts:
-            self.readouts[readout].set(record[readout])
+            self.readouts[readout].capture(record[readout])
+        self.depthPlot.add(record)
 
-        # fifth: save persistently the record number
+        # fourth: save persistently the record number
         self.last_record = record["record_number"]
 
+        return record
+
+    def displayRecord(self, record):
+        # fifth: update display, at most once per DISPLAY_INTERVAL
+        self.latestRecord = record
+        if not self.renderPending:
+            self.renderPending = True
+            QtCore.QTimer.singleShot(DISPLAY_INTERVAL, self.renderReadouts)
+
+    def renderReadouts(self):
+        self.renderPending = False
+        for readout in self.readouts.values():
+            readout.render()
+        if self.activePlot is not None:
+            self.activePlot.plot()
+        if self.latestRecord is not None:
+            self.updateLag(time.perf_counter() - self.latestRecord["time_received"])
+
+    def checkQuality(self, record):
+        for channel, old, new in self.quality.check(record):
+            readout = self.readouts[channel]
+            readout.setQuality(new)
+            if new == quality.SPIKE:
+                print("Quality: spike in %s at record %.0f: %g" % (readout.label, record["record_number"], record[channel]))
+            elif new != quality.OK:
+                print("Quality: %s in %s from record %.0f" % (new, readout.label, record["record_number"]))
+            elif old != quality.SPIKE:
+                print("Quality: %s in %s ended at record %.0f" % (old, readout.label, record["record_number"]))
+
+    def resetQuality(self):
+        # a new run starts with fresh statistics and no flags
+        self.quality.reset()
+        for channel in self.quality.channels:
+            self.readouts[channel].setQuality(quality.OK)
+
+    def updateLag(self, lag):
+        self.lag = lag
+        self.lagLabel.setText("Lag: %.0f ms" % (lag * 1000))
+        if lag >= LAG_ALARM:
+            self.lagLabel.setStyleSheet("color: red")
+        elif lag >= LAG_WARNING:
+            self.lagLabel.setStyleSheet("color: orange")
+        else:
+            self.lagLabel.setStyleSheet("")
+
+        if (lag >= LAG_ALARM) != self.lagAlarm:
+            self.lagAlarm = lag >= LAG_ALARM
+            if self.lagAlarm:
+                print("Lag ALARM: display is %.1f s behind the input" % lag)
+            else:
+                print("Lag: back below %.1f s" % LAG_ALARM)
+
+    def newDepth(self, counter, received):
+        self.encoderDepth = counter
+        self.encoderTime = received
+
     def disconnect(self):
-        if self.inputworker is not None:
+        if self.acquisition.has_source("logger"):
             print("Input worker: Stopping")
-            self.inputworker.stop()
+            self.acquisition.remove_source("logger")
 
     def closeSaveFile(self):
         print("Save file: Closed")
         self.last_record = ""
         self.savefilename = None
 
-    def setInputWorker(self, worker):
-        self.disconnect()
-        self.inputworker = worker
-        self.inputworker.update_signal.connect(self.newData)
-        # self.connect(self.inputworker, QtCore.SIGNAL("update(QString)"), self.newData )
-        # self.get_thread.update.connect(self.newData)
+    def setInputSource(self, source, port=None):
+        # replaces the running logger source, if any. port is its serial port, if it has one
+        self.loggerPort = port
+        self.acquisition.add_source("logger", source)
 
     def closeEvent(self, evnt):
         if self.recording:
             print("Recording: Cannot close when recording. Stop recording first!")
             evnt.ignore()
         else:
-            self.disconnect()
+            self.acquisition.stop()
             super(MainWindow, self).closeEvent(evnt)
 
 
@@ -632,10 +1085,10 @@ class MainWindow(QtWidgets.QMainWindow):
     # write text to log
     def log(self, text):
         sys.stdin.question(text)
-        self.console.setText(self.console.toPlainText() + text)
         cursor = QtGui.QTextCursor(self.console.textCursor())
         cursor.movePosition(QtGui.QTextCursor.End, QtGui.QTextCursor.MoveAnchor)
         self.console.setTextCursor(cursor)
+        self.console.insertPlainText(text)
         self.console.ensureCursorVisible()
         # save to logfile
         if self.savefilename is not None:
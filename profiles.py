@@ -0,0 +1,290 @@
+"""
+Depth binned profiles.
+
+Records are binned by depth (depth_winch by default) into fixed size bins,
+and for every channel count/mean/min/max/std is kept per bin. Down runs
+(depth increasing) and up runs are kept apart. A profile is either built
+record by record while logging (DepthProfile.add, O(1) per record) or in one
+go from the columns of a finished log (profile_from_columns).
+
+Angles that wrap around (corrections.PERIODIC_CHANNELS: heading, roll,
+azimuth) get circular statistics, so a roll flipping between 179.9 and
+-179.9 averages to 180, not 0.
+"""
+
+import math
+
+import numpy as np
+
+import corrections
+
+DOWN = "down"
+UP = "up"
+
+DEFAULT_BIN_SIZE = 1.0  # m
+
+STAT_NAMES = ("count", "mean", "std", "min", "max")
+
+
+class BinStats:
+    """Running count/mean/min/max/variance of one channel in one bin (Welford)"""
+
+    __slots__ = ("count", "mean", "m2", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.count) if self.count else math.nan
+
+
+class CircularBinStats:
+    """Count/mean/min/max/std of an angle channel in one bin, taken on the circle.
+
+    The mean is the direction of the summed unit vectors, the std the circular
+    standard deviation. min and max are the extremes relative to the first
+    value, so a bin straddling the wrap (179.9, -179.9) reports min 179.9 and
+    max 180.1 instead of the whole range.
+    """
+
+    __slots__ = ("low", "high", "scale", "count", "sin", "cos", "ref", "lo", "hi")
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.scale = 2 * math.pi / (high - low)  # to radians
+        self.count = 0
+        self.sin = 0.0
+        self.cos = 0.0
+        self.ref = math.nan
+        self.lo = 0.0  # deviations from ref, wrapped into half a period
+        self.hi = 0.0
+
+    def add(self, value):
+        if self.count == 0:
+            self.ref = value
+        self.count += 1
+        angle = value * self.scale
+        self.sin += math.sin(angle)
+        self.cos += math.cos(angle)
+        half = (self.high - self.low) / 2
+        deviation = corrections.wrap(value - self.ref, -half, half)
+        if deviation < self.lo:
+            self.lo = deviation
+        if deviation > self.hi:
+            self.hi = deviation
+
+    @property
+    def mean(self):
+        if not self.count:
+            return math.nan
+        return corrections.wrap(math.atan2(self.sin, self.cos) / self.scale, self.low, self.high)
+
+    @property
+    def std(self):
+        if not self.count:
+            return math.nan
+        r = min(1.0, math.hypot(self.sin, self.cos) / self.count)
+        return math.sqrt(-2.0 * math.log(r)) / self.scale if r > 0 else math.inf
+
+    @property
+    def min(self):
+        return corrections.wrap(self.ref + self.lo, self.low, self.high) if self.count else math.nan
+
+    @property
+    def max(self):
+        return self.min + (self.hi - self.lo) if self.count else math.nan
+
+
+def bin_stats(channel):
+    """Statistics accumulator for one channel in one bin"""
+    if channel in corrections.PERIODIC_CHANNELS:
+        return CircularBinStats(*corrections.PERIODIC_CHANNELS[channel])
+    return BinStats()
+
+
+class DepthProfile:
+    """Incrementally updated depth profile of a set of channels"""
+
+    def __init__(self, channels, bin_size=DEFAULT_BIN_SIZE, depth_key="depth_winch"):
+        self.channels = list(channels)
+        self.bin_size = bin_size
+        self.depth_key = depth_key
+        self.bins = {DOWN: {}, UP: {}}
+        self.direction = DOWN
+        self.last_depth = math.nan
+
+    def reset(self):
+        self.bins = {DOWN: {}, UP: {}}
+        self.direction = DOWN
+        self.last_depth = math.nan
+
+    def add(self, record):
+        depth = record.get(self.depth_key, math.nan)
+        if math.isnan(depth):
+            return
+
+        # direction only changes on actual movement, standing still keeps the current run
+        if depth > self.last_depth:
+            self.direction = DOWN
+        elif depth < self.last_depth:
+            self.direction = UP
+        self.last_depth = depth
+
+        index = int(math.floor(depth / self.bin_size))
+        stats = self.bins[self.direction].get(index)
+        if stats is None:
+            stats = self.bins[self.direction][index] = [bin_stats(c) for c in self.channels]
+
+        for channel, s in zip(self.channels, stats):
+            value = record.get(channel, math.nan)
+            if not math.isnan(value):
+                s.add(value)
+
+    def table(self, direction=DOWN):
+        """Profile as {"depth": bin centers, channel: {stat: array}} sorted by depth"""
+        bins = self.bins[direction]
+        indices = sorted(bins)
+        result = {"depth": (np.array(indices, dtype=float) + 0.5) * self.bin_size}
+        for i, channel in enumerate(self.channels):
+            stats = [bins[idx][i] for idx in indices]
+            count = np.array([s.count for s in stats], dtype=float)
+            empty = count == 0
+            result[channel] = {
+                "count": count,
+                "mean": np.where(empty, np.nan, [s.mean for s in stats]),
+                "std": np.array([s.std for s in stats], dtype=float),
+                "min": np.where(empty, np.nan, [s.min for s in stats]),
+                "max": np.where(empty, np.nan, [s.max for s in stats]),
+            }
+        return result
+
+    def save(self, filename):
+        """Writes both runs to a csv file with one row per (direction, bin)"""
+        save_profile(filename, self.channels, {DOWN: self.table(DOWN), UP: self.table(UP)})
+
+
+def _write_table(f, direction, channels, table):
+    for row, depth in enumerate(table["depth"]):
+        values = ["%e" % depth]
+        for channel in channels:
+            values += ["%e" % table[channel][stat][row] for stat in STAT_NAMES]
+        f.write(direction + "," + ",".join(values) + "\n")
+
+
+def run_directions(depth, initial=1):
+    """+1 for records on a down run, -1 on an up run (standing still keeps the previous direction)
+
+    initial is the direction before the first record.
+    """
+    depth = np.asarray(depth, dtype=float)
+    step = np.sign(np.diff(depth, prepend=np.nan))
+    step[np.isnan(step)] = 0
+    moving = step != 0
+    # forward fill the last nonzero step
+    last = np.maximum.accumulate(np.where(moving, np.arange(len(step)), -1))
+    direction = np.where(last >= 0, step[np.maximum(last, 0)], initial)
+    return direction.astype(int)
+
+
+def profile_from_columns(columns, channels, bin_size=DEFAULT_BIN_SIZE, depth_key="depth_winch"):
+    """Vectorized profile of a finished log.
+
+    :param columns: dict of equal length arrays, e.g. np.load() of a reprocessed .npz
+    :returns: {DOWN: table, UP: table}, with tables as in DepthProfile.table
+    """
+    depth = np.asarray(columns[depth_key], dtype=float)
+    valid_depth = ~np.isnan(depth)
+    # nan depths do not move the run, forward fill them so they do not look like reversals
+    filled = np.maximum.accumulate(np.where(valid_depth, np.arange(len(depth)), 0))
+    direction = run_directions(depth[filled])
+
+    result = {}
+    for name, sign in ((DOWN, 1), (UP, -1)):
+        sel = valid_depth & (direction == sign)
+        index = np.floor(depth[sel] / bin_size).astype(np.int64)
+        bins, inverse = np.unique(index, return_inverse=True)
+        table = {"depth": (bins + 0.5) * bin_size}
+        for channel in channels:
+            values = np.asarray(columns[channel], dtype=float)[sel]
+            if channel in corrections.PERIODIC_CHANNELS:
+                table[channel] = _binned_circular_stats(values, inverse, len(bins), *corrections.PERIODIC_CHANNELS[channel])
+            else:
+                table[channel] = _binned_stats(values, inverse, len(bins))
+        result[name] = table
+    return result
+
+
+def _binned_stats(values, inverse, nbins):
+    ok = ~np.isnan(values)
+    inv = inverse[ok]
+    v = values[ok]
+    count = np.bincount(inv, minlength=nbins).astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(inv, weights=v, minlength=nbins) / count
+        var = np.bincount(inv, weights=(v - mean[inv]) ** 2, minlength=nbins) / count
+    vmin = np.full(nbins, np.inf)
+    vmax = np.full(nbins, -np.inf)
+    np.minimum.at(vmin, inv, v)
+    np.maximum.at(vmax, inv, v)
+    empty = count == 0
+    vmin[empty] = np.nan
+    vmax[empty] = np.nan
+    return {"count": count, "mean": mean, "std": np.sqrt(var), "min": vmin, "max": vmax}
+
+
+def _binned_circular_stats(values, inverse, nbins, low, high):
+    """As _binned_stats for an angle channel, the same statistics as CircularBinStats"""
+    ok = ~np.isnan(values)
+    inv = inverse[ok]
+    v = values[ok]
+    scale = 2 * np.pi / (high - low)
+    count = np.bincount(inv, minlength=nbins).astype(float)
+    s = np.bincount(inv, weights=np.sin(v * scale), minlength=nbins)
+    c = np.bincount(inv, weights=np.cos(v * scale), minlength=nbins)
+    # first value of every bin, the reference of min and max
+    first = np.full(nbins, len(v))
+    np.minimum.at(first, inv, np.arange(len(v)))
+    empty = count == 0
+    ref = np.where(empty, np.nan, v[np.minimum(first, max(len(v) - 1, 0))] if len(v) else np.nan)
+    half = (high - low) / 2
+    deviation = corrections.wrap(v - ref[inv], -half, half)
+    lo = np.zeros(nbins)
+    hi = np.zeros(nbins)
+    np.minimum.at(lo, inv, deviation)
+    np.maximum.at(hi, inv, deviation)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = corrections.wrap(np.arctan2(s, c) / scale, low, high)
+        r = np.minimum(1.0, np.hypot(s, c) / count)
+        std = np.sqrt(-2.0 * np.log(r)) / scale
+    vmin = corrections.wrap(ref + lo, low, high)
+    vmax = vmin + (hi - lo)
+    mean[empty] = np.nan
+    std[empty] = np.nan
+    return {"count": count, "mean": mean, "std": std, "min": vmin, "max": vmax}
+
+
+def save_profile(filename, channels, profile):
+    """Writes a profile_from_columns result in the same layout as DepthProfile.save"""
+    with open(filename, "w") as f:
+        header = ['"direction"', '"depth"']
+        for channel in channels:
+            header += ['"%s_%s"' % (channel, stat) for stat in STAT_NAMES]
+        f.write(",".join(header) + "\n")
+        for direction in (DOWN, UP):
+            _write_table(f, direction, channels, profile[direction])
@@ -0,0 +1,129 @@
+"""
+Streaming data quality monitor.
+
+Every monitored channel keeps exponentially weighted running statistics
+(a Welford style update of mean and variance, the current nan run and
+flat run length), so a record costs a few float operations per channel and
+memory is constant. From those a channel is flagged as
+
+    spike     value more than SPIKE_SIGMA standard deviations from the mean
+    flatline  the exact same value for FLATLINE_RECORDS records
+    dropout   nan (bad checksum, missing sensor) for DROPOUT_RECORDS records
+
+A channel is only monitored once it has had a valid value, so channels that
+are not available at all (depth_winch without encoder) are not flagged.
+
+QualityMonitor.check returns the channels whose state changed.
+"""
+
+import math
+
+import corrections
+
+OK = "ok"
+SPIKE = "spike"
+FLATLINE = "flatline"
+DROPOUT = "dropout"
+
+ALPHA = 0.05  # weight of the newest value in the running statistics, ~20 records memory
+WARMUP = 20  # records before spikes are flagged
+SPIKE_SIGMA = 6.0
+SPIKE_RECORDS = 3  # longer runs of outliers are a change of level, the statistics restart
+MIN_STD = 1e-6  # below this the channel counts as constant, not spiky
+FLATLINE_RECORDS = 50
+DROPOUT_RECORDS = 3
+
+# channels that are constant or step like by nature are not checked for flatlines or spikes
+NO_FLATLINE = ("button", "depth_winch", "trajectory_x", "trajectory_y", "trajectory_z")
+NO_SPIKE = ("button",)
+
+# angles wrap around, so -179.9 follows 179.9 without a spike
+PERIODS = {name: high - low for name, (low, high) in corrections.PERIODIC_CHANNELS.items()}
+
+
+class ChannelMonitor:
+
+    __slots__ = ("flatline", "spikes", "period", "seen", "spike_run", "count", "mean", "var", "last", "nan_run", "flat_run", "state")
+
+    def __init__(self, flatline=True, spikes=True, period=None):
+        self.flatline = flatline
+        self.spikes = spikes
+        self.period = period
+        self.seen = False  # had a valid value
+        self.spike_run = 0
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.last = math.nan
+        self.nan_run = 0
+        self.flat_run = 0
+        self.state = OK
+
+    @property
+    def std(self):
+        return math.sqrt(self.var)
+
+    def update(self, value):
+        """Adds a value, returns the new state"""
+        if math.isnan(value):
+            if not self.seen:
+                return OK
+            self.nan_run += 1
+            # short gaps keep the current state
+            return DROPOUT if self.nan_run >= DROPOUT_RECORDS else self.state
+        self.nan_run = 0
+        self.seen = True
+
+        if value == self.last:
+            self.flat_run += 1
+        else:
+            self.flat_run = 0
+
+        deviation = value - self.mean
+        if self.period is not None:
+            deviation = (deviation + self.period / 2) % self.period - self.period / 2
+        std = self.std
+        if self.spikes and self.count >= WARMUP and std > MIN_STD and abs(deviation) > SPIKE_SIGMA * std:
+            self.spike_run += 1
+            if self.spike_run <= SPIKE_RECORDS:
+                # spikes are kept out of the statistics, so a spike does not hide the next one
+                return SPIKE
+            self.count = 0
+            self.var = 0.0
+        self.spike_run = 0
+
+        if self.count == 0:
+            self.mean = value
+        else:
+            # exponentially weighted Welford update
+            increment = ALPHA * deviation
+            self.mean += increment
+            self.var = (1.0 - ALPHA) * (self.var + deviation * increment)
+        self.count += 1
+        self.last = value
+
+        if self.flatline and self.flat_run >= FLATLINE_RECORDS:
+            return FLATLINE
+        return OK
+
+
+class QualityMonitor:
+    def __init__(self, channels):
+        self.channels = {c: self.monitor(c) for c in channels}
+
+    def reset(self):
+        self.channels = {c: self.monitor(c) for c in self.channels}
+
+    @staticmethod
+    def monitor(channel):
+        return ChannelMonitor(channel not in NO_FLATLINE, channel not in NO_SPIKE, PERIODS.get(channel))
+
+    def check(self, record):
+        """Updates all channels with a record. Returns [(channel, old state, new state)] for changed channels"""
+        changes = []
+        for channel, monitor in self.channels.items():
+            state = monitor.update(record[channel])
+            if state != monitor.state:
+                changes.append((channel, monitor.state, state))
+                monitor.state = state
+        return changes
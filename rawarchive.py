@@ -0,0 +1,181 @@
+"""
+Compressed, block seekable raw archives (.rawz).
+
+A .rawz file is a sequence of independent gzip members, each holding a
+block of complete raw lines, so `zcat file.rawz` gives back the plain .raw
+text. Blocks are written when BLOCK_LINES lines are buffered or the oldest
+buffered line is BLOCK_SECONDS old, which bounds what a crash can lose to
+one block. Next to it a .rawz.idx text file holds one line per block:
+
+    <byte offset> <byte length> <first line number> <number of lines>
+
+which gives random access to any line by decompressing a single block. If
+the index is missing or stale it is rebuilt by scanning the archive.
+"""
+
+import os
+import time
+import zlib
+import bisect
+
+FILE_SUFFIX_ARCHIVE = ".rawz"
+FILE_SUFFIX_INDEX = ".idx"
+
+BLOCK_LINES = 1000
+BLOCK_SECONDS = 60.0
+COMPRESSION_LEVEL = 6
+
+GZIP_WBITS = 31  # zlib window bits for gzip framing
+SCAN_CHUNK = 65536  # bytes read at a time when rebuilding the index
+
+
+def is_archive(filename):
+    return filename.endswith(FILE_SUFFIX_ARCHIVE)
+
+
+class RawArchiveWriter:
+    def __init__(self, filename, block_lines=BLOCK_LINES, block_seconds=BLOCK_SECONDS):
+        self.filename = filename
+        self.block_lines = block_lines
+        self.block_seconds = block_seconds
+        self.lines = []
+        self.block_started = 0.0
+
+        # continue an existing archive, dropping a block that was cut short by a crash
+        blocks = read_index(filename)
+        self.datafile = open(filename, "ab")
+        self.datafile.truncate(blocks[-1][0] + blocks[-1][1] if blocks else 0)
+        self.datafile.seek(0, os.SEEK_END)
+        self.indexfile = open(filename + FILE_SUFFIX_INDEX, "w")
+        for block in blocks:
+            self.indexfile.write("%d %d %d %d\n" % block)
+        self.indexfile.flush()
+        self.nlines = sum(block[3] for block in blocks)
+
+    def write(self, line):
+        if not self.lines:
+            self.block_started = time.monotonic()
+        self.lines.append(line)
+        if len(self.lines) >= self.block_lines or time.monotonic() - self.block_started >= self.block_seconds:
+            self.flush()
+
+    def flush(self):
+        if not self.lines:
+            return
+        data = ("\n".join(self.lines) + "\n").encode("utf-8")
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+        block = compressor.compress(data) + compressor.flush()
+
+        offset = self.datafile.tell()
+        self.datafile.write(block)
+        self.datafile.flush()
+        os.fsync(self.datafile.fileno())
+        self.indexfile.write("%d %d %d %d\n" % (offset, len(block), self.nlines, len(self.lines)))
+        self.indexfile.flush()
+
+        self.nlines += len(self.lines)
+        self.lines = []
+
+    def close(self):
+        self.flush()
+        self.datafile.close()
+        self.indexfile.close()
+
+
+def read_index(filename, scan=True):
+    """Block index of an archive as a list of (offset, length, first line, number of lines).
+
+    Falls back to scanning the archive when the index does not cover the whole
+    file. With scan=False the indexed blocks within the file are used as they
+    are, e.g. to read the end of a large archive quickly after a crash.
+    """
+    if not os.path.exists(filename):
+        return []
+    blocks = []
+    try:
+        with open(filename + FILE_SUFFIX_INDEX) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 4:
+                    blocks.append(tuple(int(x) for x in fields))
+    except OSError:
+        pass
+
+    size = os.path.getsize(filename)
+    if not scan:
+        return [b for b in blocks if b[0] + b[1] <= size]
+    end = blocks[-1][0] + blocks[-1][1] if blocks else 0
+    if end != size:
+        blocks = scan_index(filename)
+    return blocks
+
+
+def scan_index(filename):
+    """Rebuilds the block index by decompressing the archive. A truncated last block is left out"""
+    blocks = []
+    nlines = 0
+    offset = 0
+    pending = b""  # read past the end of the previous block
+    with open(filename, "rb") as f:
+        while True:
+            # one gzip member, streamed from the file
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+            length = 0
+            count = 0
+            data = pending
+            while not decompressor.eof:
+                if not data:
+                    data = f.read(SCAN_CHUNK)
+                    if not data:
+                        return blocks  # end of file, or a truncated block
+                try:
+                    count += decompressor.decompress(data).count(b"\n")
+                except zlib.error:
+                    return blocks
+                pending = decompressor.unused_data
+                length += len(data) - len(pending)
+                data = b""
+            blocks.append((offset, length, nlines, count))
+            nlines += count
+            offset += length
+
+
+class RawArchiveReader:
+    def __init__(self, filename, scan=True, blocks=None):
+        """blocks: an index (or part of one) from read_index, to not read it again"""
+        self.filename = filename
+        self.blocks = read_index(filename, scan) if blocks is None else list(blocks)
+        self.first_lines = [block[2] for block in self.blocks]
+
+    def __len__(self):
+        return self.blocks[-1][2] + self.blocks[-1][3] if self.blocks else 0
+
+    def block(self, k):
+        """Lines of block k"""
+        offset, length, _, _ = self.blocks[k]
+        with open(self.filename, "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        return zlib.decompress(data, GZIP_WBITS).decode("utf-8", errors="replace").splitlines()
+
+    def line(self, n):
+        """Line number n (0 based), decompressing only the block that holds it"""
+        if not 0 <= n < len(self):
+            raise IndexError(n)
+        k = bisect.bisect_right(self.first_lines, n) - 1
+        return self.block(k)[n - self.blocks[k][2]]
+
+    def lines(self, start_block=0, end_block=None):
+        """Streams the lines of blocks [start_block, end_block)"""
+        for k in range(start_block, len(self.blocks) if end_block is None else end_block):
+            yield from self.block(k)
+
+
+def iter_raw_lines(filename):
+    """Lines of a plain .raw or a compressed .rawz file"""
+    if is_archive(filename):
+        yield from RawArchiveReader(filename).lines()
+    else:
+        with open(filename, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                yield line.rstrip("\n")
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+Offline reprocessing of .raw backups.
+
+Reparses one or more .raw files (as written by MainWindow.processLine) with the
+current corrections.parseRecord and writes the records in their original
+order to .csv (same layout as the GUI writes) or to a columnar .npz file.
+
+Large files are split into line aligned chunks which are parsed in a process
+pool, so a season of logs is reparsed using all cores.
+
+    python reprocess.py season/*.raw --offset pressure_top=0.012 --format npz
+
+Offsets correct the inputs of the derived channels (delta_pressure,
+density, ...; see corrections.register_derived); the measured channels are
+written as recorded.
+
+Note: the winch depth is not part of the .raw stream, so depth_winch is nan
+in the reprocessed output.
+"""
+
+import os
+import sys
+import time
+import math
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor
+
+import corrections
+import rawarchive
+import trajectory
+
+CHUNK_SIZE = 4 * 1024 * 1024  # bytes per work unit
+
+
+def split_chunks(filename, chunk_size=CHUNK_SIZE):
+    """Splits a file in (filename, start, end) byte ranges that begin and end on line boundaries.
+
+    For .rawz archives the ranges are (filename, start, end, blocks) with
+    block numbers and the index entries of those blocks, so the workers do
+    not read the index again.
+    """
+    if rawarchive.is_archive(filename):
+        return split_archive_chunks(filename, chunk_size)
+
+    size = os.path.getsize(filename)
+    chunks = []
+    with open(filename, "rb") as f:
+        start = 0
+        while start < size:
+            end = min(start + chunk_size, size)
+            if end < size:
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            chunks.append((filename, start, end))
+            start = end
+    return chunks
+
+
+def split_archive_chunks(filename, chunk_size=CHUNK_SIZE):
+    chunks = []
+    start = 0
+    nbytes = 0
+    blocks = rawarchive.read_index(filename)
+    for k, block in enumerate(blocks):
+        nbytes += block[1]
+        if nbytes >= chunk_size or k == len(blocks) - 1:
+            chunks.append((filename, start, k + 1, blocks[start : k + 1]))
+            start = k + 1
+            nbytes = 0
+    return chunks
+
+
+def read_chunk_lines(filename, start, end, blocks=None):
+    if rawarchive.is_archive(filename):
+        return list(rawarchive.RawArchiveReader(filename, blocks=blocks).lines())
+    with open(filename, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return data.decode("utf-8", errors="replace").splitlines()
+
+
+def parse_lines(lines, offsets):
+    """Parses lines into records, with the trajectory channels as the GUI records them.
+
+    Returns (records, number of bad lines). Without depth_winch only inclination
+    and azimuth have values.
+    """
+    records = []
+    bad = 0
+    path = trajectory.Trajectory()
+    for line in lines:
+        line = line.rstrip()
+        if line == "":
+            continue
+        try:
+            record = corrections.parseRecord(line, offsets)
+        except corrections.ParseException:
+            bad += 1
+            continue
+        record.update(path.add(record))
+        records.append(record)
+    return records, bad
+
+
+def _process_chunk(args):
+    chunk, offsets, fmt = args
+    records, bad = parse_lines(read_chunk_lines(*chunk), offsets)
+    keys = corrections.csv_keys(records[0]) if records else []
+    if fmt == "csv":
+        return "".join(corrections.csv_line(r) for r in records), keys, len(records), bad
+    columns = {key: [r[key] for r in records] for key in keys}
+    return columns, keys, len(records), bad
+
+
+def reprocess(filenames, output, offsets=None, fmt="csv", processes=None, chunk_size=CHUNK_SIZE):
+    """Reparses the .raw files (in order) into a single output file. Returns the number of records"""
+    offsets = offsets or {}
+    chunks = []
+    for filename in filenames:
+        chunks += split_chunks(filename, chunk_size)
+
+    nbytes = sum(os.path.getsize(filename) for filename in filenames)
+    nrecords = 0
+    nbad = 0
+    t0 = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        results = pool.map(_process_chunk, [(c, offsets, fmt) for c in chunks])
+
+        if fmt == "csv":
+            with open(output, "w") as datafile:
+                for text, keys, n, bad in results:
+                    if n and nrecords == 0:
+                        datafile.write(corrections.csv_header(keys))
+                    datafile.write(text)
+                    nrecords += n
+                    nbad += bad
+        else:
+            import numpy as np
+
+            parts = []
+            for columns, keys, n, bad in results:
+                if n:
+                    parts.append(columns)
+                nrecords += n
+                nbad += bad
+            keys = parts[0].keys() if parts else []
+            np.savez(output, **{k: np.concatenate([np.asarray(p[k], dtype=float) for p in parts]) for k in keys})
+
+    dt = time.perf_counter() - t0
+    print(
+        "Reprocess: %d records (%d bad lines) from %d files in %.1f s - %.0f records/s, %.1f MB/s"
+        % (nrecords, nbad, len(filenames), dt, nrecords / dt if dt else math.inf, nbytes / 1e6 / dt if dt else math.inf)
+    )
+    return nrecords
+
+
+def parse_offsets(items):
+    offsets = {}
+    for item in items or []:
+        name, _, value = item.partition("=")
+        offsets[name.strip()] = float(value)
+    return offsets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reparse DL20 .raw backups into .csv or columnar .npz")
+    parser.add_argument("raw", nargs="+", help=".raw/.rawz files, processed and written in the given order")
+    parser.add_argument("-o", "--output", help="output file (default: first input with .csv/.npz suffix)")
+    parser.add_argument("-f", "--format", choices=["csv", "npz"], default="csv")
+    parser.add_argument("--offset", action="append", metavar="NAME=VALUE", help="offset to apply, may be repeated")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="bytes per work unit")
+    args = parser.parse_args(argv)
+
+    output = args.output or os.path.splitext(args.raw[0])[0] + "." + args.format
+    reprocess(args.raw, output, parse_offsets(args.offset), args.format, args.processes, args.chunk_size)
+    print("Reprocess: wrote", output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
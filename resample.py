@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+Resampling of recorded logs onto uniform depth or time grids.
+
+The grid is every `step` of a key column (depth_winch, depth_bottom,
+time_received, ...), aligned to multiples of step. Three modes:
+
+    interp   linear interpolation between the samples around a grid point
+    nearest  value of the closest sample
+    mean     average of the samples within +-step/2 of a grid point
+
+For interp and nearest a grid point is nan when the samples around it are
+more than max_gap apart, so gaps (nan values, winch jumps) are not papered
+over. Samples with the same key value (winch standing still) are averaged.
+Every down and up run (see profiles.run_directions) is resampled on its
+own, so a reversal gives a new run of grid points in the other direction;
+the output has a "direction" column (+1 down, -1 up).
+
+Angles that wrap around (corrections.PERIODIC_CHANNELS: heading, roll,
+azimuth) are resampled on the unit circle, as sine and cosine, so a roll
+flipping between 179.9 and -179.9 resamples to 180, not 0.
+
+StreamResampler works on chunks of columns and only keeps the samples of
+the current run it still needs, with samples of equal key merged, so files
+of any length resample in bounded memory, also while the winch stands still:
+
+    python resample.py session.csv -o session_1cm.csv --key depth_winch --step 0.01 --mode mean
+"""
+
+import sys
+import math
+import argparse
+import itertools
+
+import numpy as np
+
+import profiles
+import corrections
+
+INTERP = "interp"
+NEAREST = "nearest"
+MEAN = "mean"
+MODES = (INTERP, NEAREST, MEAN)
+
+DEFAULT_GAP_STEPS = 10  # default max_gap, in steps
+
+# internal series names: angles are resampled as their sine and cosine, every
+# series carries the number of samples each value stands for
+SINE = ":sin"
+COSINE = ":cos"
+WEIGHT = ":weight"
+
+
+class StreamResampler:
+    def __init__(self, key, step, mode=INTERP, channels=None, max_gap=None):
+        if mode not in MODES:
+            raise ValueError("unknown resampling mode %r" % mode)
+        self.key = key
+        self.step = step
+        self.mode = mode
+        self.channels = channels
+        self.max_gap = DEFAULT_GAP_STEPS * step if max_gap is None else max_gap
+        self.carry = None  # samples of the current run still needed, equal keys collapsed
+        self.direction = 1  # direction of the current run
+        self.next_k = None  # next grid point of the current run, in steps
+
+    def feed(self, columns):
+        """Adds a chunk of columns, returns the grid points that are now final"""
+        return self._process(columns, final=False)
+
+    def finish(self):
+        """Returns the remaining grid points of the last run"""
+        return self._process(None, final=True)
+
+    def _series(self):
+        """Internal series: a channel, or the sine and cosine of an angle channel"""
+        series = []
+        for c in self.channels:
+            if c in corrections.PERIODIC_CHANNELS:
+                series += [c + SINE, c + COSINE]
+            else:
+                series.append(c)
+        return series
+
+    def _prepare(self, columns):
+        # every series has a value and a weight (the number of samples it stands for)
+        data = {self.key: np.asarray(columns[self.key], dtype=float)}
+        for c in self.channels:
+            v = np.asarray(columns[c], dtype=float)
+            if c in corrections.PERIODIC_CHANNELS:
+                low, high = corrections.PERIODIC_CHANNELS[c]
+                angle = v * (2 * np.pi / (high - low))
+                values = {c + SINE: np.sin(angle), c + COSINE: np.cos(angle)}
+            else:
+                values = {c: v}
+            for n, v in values.items():
+                valid = ~np.isnan(v)
+                data[n] = np.where(valid, v, 0.0)
+                data[n + WEIGHT] = valid.astype(float)
+        return data
+
+    def _process(self, columns, final):
+        if self.channels is None and columns is not None:
+            self.channels = [c for c in columns if c != self.key]
+        self.channels = list(self.channels or [])
+        parts = [] if self.carry is None else [self.carry]
+        if columns is not None:
+            parts.append(self._prepare(columns))
+        if not parts:
+            return self._empty()
+        data = {n: np.concatenate([p[n] for p in parts]) for n in parts[0]}
+        keep = ~np.isnan(data[self.key])
+        data = {n: v[keep] for n, v in data.items()}
+        self.carry = None
+        if len(data[self.key]) == 0:
+            return self._empty()
+
+        directions = profiles.run_directions(data[self.key], self.direction)
+        starts = np.flatnonzero(np.diff(directions)) + 1
+        bounds = [0] + list(starts) + [len(directions)]
+        out = []
+        for r in range(len(bounds) - 1):
+            last = r == len(bounds) - 2
+            if r > 0:
+                self.next_k = None
+            sign = directions[bounds[r]]
+            self.direction = sign
+            rows = slice(bounds[r], bounds[r + 1])
+            run = {n: v[rows] for n, v in data.items()}
+            out.append(self._run(run, sign, final or not last))
+            if last and not final:
+                self._keep_tail(run, sign)
+        if final:
+            self.next_k = None
+        return self._output({n: np.concatenate([o[n] for o in out]) for n in out[0]})
+
+    def _output(self, result):
+        """Channels from the internal series, angles back from their sine and cosine"""
+        output = {self.key: result[self.key], "direction": result["direction"]}
+        for c in self.channels:
+            if c in corrections.PERIODIC_CHANNELS:
+                low, high = corrections.PERIODIC_CHANNELS[c]
+                angle = np.arctan2(result[c + SINE], result[c + COSINE]) * ((high - low) / (2 * np.pi))
+                output[c] = corrections.wrap(angle, low, high)
+            else:
+                output[c] = result[c]
+        return output
+
+    def _empty(self):
+        return {n: np.empty(0) for n in [self.key, "direction"] + list(self.channels or [])}
+
+    def _run(self, run, sign, final):
+        """Grid points of one run. Works in sign * key, which increases along the run"""
+        x = sign * run[self.key]
+        step = self.step
+        if self.next_k is None:
+            if self.mode == MEAN:
+                self.next_k = int(math.floor(x[0] / step + 0.5))
+            else:
+                self.next_k = int(math.ceil(x[0] / step))
+
+        x_last = x[-1]
+        if self.mode == MEAN:
+            # a bin is final once the run has passed its upper edge
+            last_k = math.floor(x_last / step + 0.5) if final else math.floor(x_last / step - 0.5)
+        else:
+            if final:
+                last_k = math.floor(x_last / step)
+            else:
+                # later samples may still land on x_last, and a channel whose last valid
+                # sample is within max_gap of it may still be bridged by later samples
+                before = x < x_last
+                limit = x[before][-1] if before.any() else -math.inf
+                for n in self._series():
+                    valid = x[before & (run[n + WEIGHT] > 0)]
+                    if len(valid) and x_last - valid[-1] <= self.max_gap:
+                        limit = min(limit, valid[-1])
+                # last k with k * step <= limit, exact in the float grid values used below
+                if limit == -math.inf:
+                    last_k = self.next_k - 1
+                else:
+                    last_k = math.floor(limit / step)
+                    while (last_k + 1) * step <= limit:
+                        last_k += 1
+                    while last_k * step > limit:
+                        last_k -= 1
+
+        k = np.arange(self.next_k, max(self.next_k, last_k + 1))
+        self.next_k += len(k)
+        grid = k * step
+        result = {self.key: sign * grid, "direction": np.full(len(k), float(sign))}
+        for n in self._series():
+            if self.mode == MEAN:
+                result[n] = _block_mean(x, run[n], run[n + WEIGHT], k, step)
+            else:
+                result[n] = _interpolate(x, run[n], run[n + WEIGHT], grid, self.max_gap, self.mode == NEAREST)
+        return result
+
+    def _keep_tail(self, run, sign):
+        # samples that can still contribute to the next grid point. Samples with
+        # the same key (winch standing still) are merged into one weighted sample,
+        # so the carry stays small however long the winch stands
+        x = sign * run[self.key]
+        margin = self.step / 2 if self.mode == MEAN else self.max_gap
+        keep = x >= self.next_k * self.step - margin - 1e-9 * self.step
+        xu, inverse = np.unique(x[keep], return_inverse=True)  # x increases along the run
+        carry = {self.key: sign * xu}
+        for n in self._series():
+            weight = np.bincount(inverse, weights=run[n + WEIGHT][keep], minlength=len(xu))
+            total = np.bincount(inverse, weights=(run[n] * run[n + WEIGHT])[keep], minlength=len(xu))
+            carry[n] = np.divide(total, weight, out=np.zeros(len(xu)), where=weight > 0)
+            carry[n + WEIGHT] = weight
+        self.carry = carry
+
+
+def _collapse(x, v, w):
+    """Drops samples without weight and takes the weighted mean of values with the same x (x sorted)"""
+    ok = w > 0
+    x = x[ok]
+    v = v[ok]
+    w = w[ok]
+    xu = np.unique(x)
+    if len(xu) == len(x):
+        return x, v
+    inverse = np.searchsorted(xu, x)
+    return xu, np.bincount(inverse, weights=v * w) / np.bincount(inverse, weights=w)
+
+
+def _interpolate(x, v, w, grid, max_gap, nearest):
+    xu, vu = _collapse(x, v, w)
+    result = np.full(len(grid), np.nan)
+    if len(xu) == 0 or len(grid) == 0:
+        return result
+    i = np.searchsorted(xu, grid, side="right")
+    left = np.clip(i - 1, 0, len(xu) - 1)
+    right = np.clip(i, 0, len(xu) - 1)
+    exact = (i > 0) & (xu[left] == grid)
+    inside = (i > 0) & (i < len(xu)) & (xu[right] - xu[left] <= max_gap)
+    if nearest:
+        closer = np.where(grid - xu[left] <= xu[right] - grid, left, right)
+        values = vu[closer]
+    else:
+        values = np.interp(grid, xu, vu)
+    result[inside] = values[inside]
+    result[exact] = vu[left[exact]]
+    return result
+
+
+def _block_mean(x, v, w, k, step):
+    result = np.full(len(k), np.nan)
+    if len(k) == 0:
+        return result
+    ok = w > 0
+    b = np.floor(x[ok] / step + 0.5).astype(np.int64) - k[0]
+    inside = (b >= 0) & (b < len(k))
+    count = np.bincount(b[inside], weights=w[ok][inside], minlength=len(k))
+    total = np.bincount(b[inside], weights=(v * w)[ok][inside], minlength=len(k))
+    filled = count > 0
+    result[filled] = total[filled] / count[filled]
+    return result
+
+
+def resample_columns(columns, key, step, mode=INTERP, channels=None, max_gap=None):
+    """Resamples a whole log at once, columns as a dict of arrays"""
+    resampler = StreamResampler(key, step, mode, channels, max_gap)
+    parts = [resampler.feed(columns), resampler.finish()]
+    return {n: np.concatenate([p[n] for p in parts]) for n in parts[0]}
+
+
+def resample_csv(infile, outfile, key, step, mode=INTERP, channels=None, max_gap=None, chunk_lines=corrections.CSV_CHUNK_LINES):
+    resampler = StreamResampler(key, step, mode, channels, max_gap)
+    nrows = 0
+    with open(outfile, "w") as out:
+        header = None
+        chunks = itertools.chain(
+            (resampler.feed(c) for c in corrections.read_csv_chunks(infile, chunk_lines)), [None]
+        )
+        for result in chunks:
+            if result is None:
+                result = resampler.finish()
+            names = list(result)
+            if header is None:
+                header = names
+                out.write(corrections.csv_header(header))
+            formats = [corrections.CSV_FORMATS.get(n, "%e") for n in header]
+            for row in zip(*[result[n] for n in header]):
+                out.write(",".join(f % v for f, v in zip(formats, row)) + "\n")
+            nrows += len(result[key])
+    return nrows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resample a DL20 .csv onto a uniform depth or time grid")
+    parser.add_argument("csv")
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--key", default="depth_winch", help="grid column, e.g. depth_winch, depth_bottom, time_received")
+    parser.add_argument("--step", type=float, required=True, help="grid spacing in units of the key column")
+    parser.add_argument("--mode", choices=MODES, default=INTERP)
+    parser.add_argument("--max-gap", type=float, default=None, help="largest gap bridged (default: %d steps)" % DEFAULT_GAP_STEPS)
+    parser.add_argument("--channels", help="comma separated channels (default: all)")
+    args = parser.parse_args(argv)
+
+    channels = args.channels.split(",") if args.channels else None
+    n = resample_csv(args.csv, args.output, args.key, args.step, args.mode, channels, args.max_gap)
+    print("Resample: wrote %d grid points to %s" % (n, args.output))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+Long run soak test of the logger GUI.
+
+Drives MainWindow offscreen with synthetic DL20 lines through the real
+acquisition core, recording to a scratch directory, for a simulated day at
+an accelerated rate. Resident memory, Python object count and the
+receive -> processed latency are sampled along the way and written to
+soak.csv. The run fails (exit code 1) if, after the warmup, memory or
+object count grow more than their budget or latency degrades.
+
+    python soak.py                      # one simulated day
+    python soak.py --hours 2 --rate 1000
+"""
+
+import os
+import gc
+import sys
+import math
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import importlib.util
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5 import QtWidgets, QtCore
+
+RECORD_INTERVAL = 2.0  # s between DL20 records in the field
+SAMPLES = 50  # measurements over the run
+WARMUP = 0.1  # fraction of the run before the baseline is taken
+
+RSS_BUDGET = 50.0  # MB growth allowed after warmup
+OBJECT_BUDGET = 20000  # Python objects growth allowed after warmup
+LATENCY_BUDGET = 2.0  # latency at the end may be at most this factor of the baseline (plus LATENCY_SLACK)
+LATENCY_SLACK = 0.005  # s
+
+
+def checksum(message):
+    value = 0
+    for c in message:
+        value ^= ord(c)
+    return "%s %02X" % (message, value)
+
+
+def synthetic_line(n, depth, rng):
+    """One DL20 line in the ISHPR/ISDPT/ISDPT layout, with valid checksums"""
+    pressure = 1.0 + depth * 0.0917
+    hpr = checksum("ISHPR,%05.2f,%.2f,%.2f" % (rng.uniform(0, 360), rng.gauss(-4.4, 0.05), rng.gauss(-179.8, 0.05)))
+    top = checksum("ISDPT,%08.3f,M,%09.4f,B,%.2f,C" % (depth, pressure, -20 + rng.gauss(0, 0.01)))
+    bottom = checksum("ISDPT,%08.3f,M,%09.4f,B,%.2f,C" % (depth + 2, pressure + 0.18, -20 + rng.gauss(0, 0.01)))
+    return "%d\t%d\t%d\t%d\t%d\t%s\t%s\t%s" % (
+        n, 21400 + rng.randint(-10, 10), 22500 + rng.randint(-10, 10), 26300, n % 2, hpr, top, bottom
+    )
+
+
+async def synthetic_source(core, window, records, rate):
+    """Feeds records lines at rate lines/s, moving the winch down and up"""
+    rng = random.Random(1)
+    for n in range(records):
+        depth = 1500.0 * abs(math.sin(math.pi * n / records * 4))
+        window.encoderDepth = -depth
+        await core.put(synthetic_line(n, depth, rng), time.perf_counter())
+        if n % 100 == 0:
+            await asyncio.sleep(100.0 / rate)
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def load_gui():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logger-gui.py")
+    spec = importlib.util.spec_from_file_location("logger_gui", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def soak(hours, rate, directory, report):
+    records = int(hours * 3600 / RECORD_INTERVAL)
+    gui = load_gui()
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    window = gui.MainWindow()
+    window.savefilename = os.path.join(directory, "soak")
+    window.encoder = True  # depth comes from the synthetic source
+    window.toggleRecording()
+
+    # per record latency, measured where the GUI has finished with a line
+    latencies = []
+    processLine = window.processLine
+
+    def timedProcessLine(line, received=None):
+        record = processLine(line, received)
+        latencies.append(time.perf_counter() - received)
+        return record
+
+    window.processLine = timedProcessLine
+
+    samples = []
+    every = max(1, records // SAMPLES)
+
+    def sample():
+        done = window.acquisition.queued
+        if samples and done - samples[-1][0] < every and done < records:
+            return
+        gc.collect()
+        recent = latencies[-every:] or [math.nan]
+        samples.append((done, rss_mb(), len(gc.get_objects()), sum(recent) / len(recent), max(recent)))
+        del latencies[:-every]
+        if done >= records and window.acquisition.backlog() == 0:
+            app.quit()
+
+    timer = QtCore.QTimer()
+    timer.timeout.connect(sample)
+    timer.start(50)
+
+    started = time.perf_counter()
+    window.setInputSource(synthetic_source(window.acquisition, window, records, rate))
+    app.exec_()
+    elapsed = time.perf_counter() - started
+
+    window.toggleRecording()
+    window.acquisition.stop()
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+
+    with open(report, "w") as f:
+        f.write('"records","rss_mb","objects","latency_mean","latency_max"\n')
+        for row in samples:
+            f.write("%d,%.1f,%d,%.6f,%.6f\n" % row)
+
+    print("Soak: %d records (%.1f simulated hours) in %.0f s, report in %s" % (records, hours, elapsed, report))
+    return check(samples)
+
+
+def check(samples):
+    """Budget violations, as a list of messages"""
+    baseline = samples[max(1, int(len(samples) * WARMUP))]
+    end = samples[-1]
+    failures = []
+    if end[1] - baseline[1] > RSS_BUDGET:
+        failures.append("memory grew %.1f MB (budget %.1f MB)" % (end[1] - baseline[1], RSS_BUDGET))
+    if end[2] - baseline[2] > OBJECT_BUDGET:
+        failures.append("object count grew %d (budget %d)" % (end[2] - baseline[2], OBJECT_BUDGET))
+    tail = [s[3] for s in samples[-max(1, len(samples) // 10):]]
+    head = [s[3] for s in samples[1 : 1 + max(1, len(samples) // 10)]]
+    latency_end = sum(tail) / len(tail)
+    latency_start = sum(head) / len(head)
+    if latency_end > LATENCY_BUDGET * latency_start + LATENCY_SLACK:
+        failures.append("latency went from %.1f ms to %.1f ms" % (latency_start * 1000, latency_end * 1000))
+    for message in failures:
+        print("Soak FAILED:", message)
+    if not failures:
+        print(
+            "Soak: OK - memory %+.1f MB, objects %+d, latency %.1f -> %.1f ms"
+            % (end[1] - baseline[1], end[2] - baseline[2], latency_start * 1000, latency_end * 1000)
+        )
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Soak test the logger GUI with synthetic DL20 data")
+    parser.add_argument("--hours", type=float, default=24.0, help="simulated run length")
+    parser.add_argument("--rate", type=float, default=2000.0, help="lines per second fed to the GUI")
+    parser.add_argument("--report", default="soak.csv")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        failures = soak(args.hours, args.rate, directory, args.report)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
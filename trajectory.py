@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+Borehole trajectory from the ISHPR orientation and the winch depth.
+
+The sonde axis is the z axis of the heading/pitch/roll sensor (mounted
+upside down in the DL20, roll near 180), taken in the direction pointing
+down the hole. From it every record gets
+
+    inclination   deg from vertical
+    azimuth       deg from north, clockwise (heading of the tilt)
+
+and, integrating the axis over the depth_winch increments with the minimum
+curvature method, the position of the sonde relative to the first record
+with a valid orientation and depth:
+
+    trajectory_x  m east
+    trajectory_y  m north
+    trajectory_z  m true vertical depth, positive down
+
+Records without orientation or depth give nan and do not move the
+position. Going up the hole integrates with negative increments, so an up
+run retraces the down run.
+
+Trajectory.add handles one record in O(1) while logging, add_columns a
+chunk of a finished log, vectorized, continuing from the same state:
+
+    python trajectory.py session.csv -o session.trajectory.csv
+"""
+
+import sys
+import math
+import argparse
+
+import numpy as np
+
+import corrections
+
+CHANNELS = ("inclination", "azimuth", "trajectory_x", "trajectory_y", "trajectory_z")
+INPUTS = ("heading", "pitch", "roll", "depth_winch")
+
+MIN_DOGLEG = 1e-9  # rad, below this the ratio factor is 1
+
+
+def axis(heading, pitch, roll):
+    """Unit vector (north, east, down) of the sonde axis, pointing down the hole. Angles in deg"""
+    h, p, r = math.radians(heading), math.radians(pitch), math.radians(roll)
+    a = math.cos(r) * math.sin(p)
+    b = -math.sin(r)
+    d = math.cos(r) * math.cos(p)
+    if d < 0:
+        a, b, d = -a, -b, -d
+    return (math.cos(h) * a - math.sin(h) * b, math.sin(h) * a + math.cos(h) * b, d)
+
+
+def axes(heading, pitch, roll):
+    """Vectorized axis, as an (n, 3) array"""
+    h, p, r = np.radians(heading), np.radians(pitch), np.radians(roll)
+    a = np.cos(r) * np.sin(p)
+    b = -np.sin(r)
+    d = np.cos(r) * np.cos(p)
+    sign = np.where(d < 0, -1.0, 1.0)
+    a, b, d = sign * a, sign * b, sign * d
+    return np.column_stack((np.cos(h) * a - np.sin(h) * b, np.sin(h) * a + np.cos(h) * b, d))
+
+
+def ratio_factor(dogleg):
+    """Minimum curvature ratio factor 2 / dogleg * tan(dogleg / 2)"""
+    if dogleg < MIN_DOGLEG:
+        return 1.0
+    return 2.0 / dogleg * math.tan(dogleg / 2.0)
+
+
+class Trajectory:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.depth = None  # measured depth of the last station
+        self.axis = None  # axis of the last station
+        self.position = [0.0, 0.0, 0.0]  # north, east, down
+
+    def resume(self, record):
+        """Continues from a recorded record (with the derived channels), e.g. after a restart"""
+        values = [record.get(k, math.nan) for k in INPUTS + ("trajectory_x", "trajectory_y", "trajectory_z")]
+        if any(math.isnan(v) for v in values):
+            return False
+        heading, pitch, roll, depth, x, y, z = values
+        self.depth = depth
+        self.axis = axis(heading, pitch, roll)
+        self.position = [y, x, z]
+        return True
+
+    def add(self, record):
+        """Derived channels of one record, also advancing the position"""
+        heading, pitch, roll, depth = (record[k] for k in INPUTS)
+        if math.isnan(heading) or math.isnan(pitch) or math.isnan(roll):
+            return dict.fromkeys(CHANNELS, math.nan)
+        t = axis(heading, pitch, roll)
+        result = {
+            "inclination": math.degrees(math.acos(min(1.0, t[2]))),
+            "azimuth": math.degrees(math.atan2(t[1], t[0])) % 360.0,
+        }
+        if math.isnan(depth):
+            result.update(trajectory_x=math.nan, trajectory_y=math.nan, trajectory_z=math.nan)
+            return result
+
+        if self.axis is not None:
+            dot = sum(u * v for u, v in zip(self.axis, t))
+            dogleg = math.acos(max(-1.0, min(1.0, dot)))
+            scale = (depth - self.depth) / 2.0 * ratio_factor(dogleg)
+            for i in range(3):
+                self.position[i] += scale * (self.axis[i] + t[i])
+        self.depth = depth
+        self.axis = t
+        result.update(trajectory_x=self.position[1], trajectory_y=self.position[0], trajectory_z=self.position[2])
+        return result
+
+    def add_columns(self, columns):
+        """Derived channels of a chunk of records (dict of arrays), vectorized"""
+        heading, pitch, roll, depth = (np.asarray(columns[k], dtype=float) for k in INPUTS)
+        n = len(depth)
+        result = {c: np.full(n, np.nan) for c in CHANNELS}
+
+        oriented = ~(np.isnan(heading) | np.isnan(pitch) | np.isnan(roll))
+        t = axes(heading[oriented], pitch[oriented], roll[oriented])
+        result["inclination"][oriented] = np.degrees(np.arccos(np.minimum(1.0, t[:, 2])))
+        result["azimuth"][oriented] = np.degrees(np.arctan2(t[:, 1], t[:, 0])) % 360.0
+
+        stations = oriented & ~np.isnan(depth)
+        t = t[~np.isnan(depth[oriented])]
+        md = depth[stations]
+        if len(md) == 0:
+            return result
+
+        # the last station of the previous chunk starts the first segment
+        if self.axis is None:
+            start = 1
+            t_all = t
+            md_all = md
+        else:
+            start = 0
+            t_all = np.vstack((self.axis, t))
+            md_all = np.concatenate(([self.depth], md))
+        dot = np.einsum("ij,ij->i", t_all[:-1], t_all[1:])
+        dogleg = np.arccos(np.clip(dot, -1.0, 1.0))
+        safe = np.where(dogleg < MIN_DOGLEG, 1.0, dogleg)
+        rf = np.where(dogleg < MIN_DOGLEG, 1.0, 2.0 / safe * np.tan(safe / 2.0))
+        steps = (np.diff(md_all) / 2.0 * rf)[:, None] * (t_all[:-1] + t_all[1:])
+
+        position = np.empty((len(md), 3))
+        if start:
+            position[0] = self.position
+        position[start:] = np.cumsum(np.vstack((self.position, steps)), axis=0)[1:]
+
+        result["trajectory_x"][stations] = position[:, 1]
+        result["trajectory_y"][stations] = position[:, 0]
+        result["trajectory_z"][stations] = position[:, 2]
+
+        self.depth = float(md[-1])
+        self.axis = tuple(t[-1])
+        self.position = list(position[-1])
+        return result
+
+
+def trajectory_from_columns(columns):
+    """Derived channels of a whole log at once, columns as a dict of arrays"""
+    return Trajectory().add_columns(columns)
+
+
+def trajectory_csv(infile, outfile, chunk_lines=corrections.CSV_CHUNK_LINES):
+    trajectory = Trajectory()
+    names = ["record_number"] + list(INPUTS)
+    header = ["record_number", "depth_winch"] + list(CHANNELS)
+    formats = [corrections.CSV_FORMATS.get(n, "%e") for n in header]
+    nrows = 0
+    with open(outfile, "w") as out:
+        out.write(corrections.csv_header(header))
+        for chunk in corrections.read_csv_chunks(infile, chunk_lines, usecols=names):
+            chunk.update(trajectory.add_columns(chunk))
+            for row in zip(*[chunk[n] for n in header]):
+                out.write(",".join(f % v for f, v in zip(formats, row)) + "\n")
+            nrows += len(chunk["record_number"])
+    return nrows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Borehole trajectory (minimum curvature) of a DL20 .csv")
+    parser.add_argument("csv")
+    parser.add_argument("-o", "--output", required=True)
+    args = parser.parse_args(argv)
+
+    n = trajectory_csv(args.csv, args.output)
+    print("Trajectory: wrote %d records to %s" % (n, args.output))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,35 +1,59 @@
+import os
 import sys
 import glob
-import serial 
+import time
+from serial.tools import list_ports
 
-def enumerate_serial():
+PORT_CACHE_SECONDS = 5.0  # how long a port listing is reused before scanning again
+
+_port_cache = (0.0, None)
+
+
+def enumerate_serial(refresh=False):
     """Lists serial ports
 
+    Ports are discovered from the OS device metadata (sysfs/udev on linux,
+    the registry on windows) instead of opening every tty node. USB ports
+    are listed first, as that is where the logger and the encoder live.
+    The listing is cached for PORT_CACHE_SECONDS.
+
+    :param refresh:
+        Ignore the cached listing and scan again
     :raises EnvironmentError:
         On unsupported or unknown platforms
     :returns:
         A list of available serial ports
     """
-    if sys.platform.startswith('win'):
-        ports = ['COM' + str(i + 1) for i in range(256)]
-
-    elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-        # this is to exclude your current terminal "/dev/tty"
-        ports = glob.glob('/dev/tty[A-Za-z]*')
+    global _port_cache
 
-    elif sys.platform.startswith('darwin'):
-        ports = glob.glob('/dev/tty.*')
+    stamp, ports = _port_cache
+    if not refresh and ports is not None and time.monotonic() - stamp < PORT_CACHE_SECONDS:
+        return list(ports)
 
-    else:
+    if not (sys.platform.startswith('win') or sys.platform.startswith('linux')
+            or sys.platform.startswith('cygwin') or sys.platform.startswith('darwin')):
         raise EnvironmentError('Unsupported platform')
 
-    result = []
-    for port in ports:
-        try:
-            s = serial.Serial(port)
-            s.close()
-            result.append(port)
-        except (OSError, serial.SerialException):
-            pass
-    return result
+    infos = sorted(list_ports.comports(), key=lambda p: (p.vid is None, p.device))
+    ports = [p.device for p in infos]
+
+    # udev symlinks for devices list_ports does not know about
+    for link in sorted(glob.glob('/dev/serial/by-id/*')):
+        if os.path.realpath(link) not in ports:
+            ports.append(link)
+
+    _port_cache = (time.monotonic(), ports)
+    return list(ports)
 
+
+def label_serial(ports):
+    """Port names annotated with their USB VID:PID and product, where known"""
+    infos = {p.device: p for p in list_ports.comports()}
+    labels = []
+    for port in ports:
+        p = infos.get(os.path.realpath(port))
+        if p is None or p.vid is None:
+            labels.append(port)
+        else:
+            labels.append("%s (%04X:%04X %s)" % (port, p.vid, p.pid, p.product or p.description))
+    return labels
@@ -1,80 +1,239 @@
+"""
+Acquisition core.
+
+All input sources (DL20 serial port, Codex560 encoder polling, file replay,
+network streams) run as coroutines on one asyncio event loop in a single
+QThread. Sources put their lines on one bounded queue, which gives
+backpressure, and a single dispatcher moves them to a second bounded,
+thread-safe queue (AcquisitionCore.lines) that the GUI drains. The GUI
+gets at most one pending ready signal however many lines are queued, so a
+stalled GUI does not pile up Qt events; when the GUI queue is full the
+dispatcher waits, and the backpressure reaches the sources. Sources are added and removed by name from the GUI thread; removing
+a source (or stopping the core) cancels its coroutine, which closes its port.
+
+Every line is emitted with time.perf_counter() taken when it was read,
+a high resolution monotonic clock used for latency and alignment.
+"""
+
+import math
 import time
+import queue
+import asyncio
+import threading
 import serial
 
-from PyQt5 import QtCore
-
-class FileInputWorker(QtCore.QThread):
-
-    update_signal = QtCore.pyqtSignal('QString', name = 'update')
-
-    def __init__(self, filename, delay=3.0):
-        QtCore.QThread.__init__(self)
-        self.alive = False
-        self.filename = filename
-        self.delay = delay
+from concurrent.futures import ThreadPoolExecutor
 
-    def __del__(self):
-        self.stop()
+from PyQt5 import QtCore
 
-    def stop(self):
-        self.alive = False
-        self.datafile.close()
-        self.wait()
+import rawarchive
 
-    def run(self):
-        self.alive = True
-        self.datafile = open(self.filename, "r", encoding='utf-8', errors ='replace')
-        while (self.alive):
-            line = self.datafile.readline()
-            #self.emit( QtCore.SIGNAL('update(QString)'), line.rstrip())
-            self.update_signal.emit(line.rstrip())
-            time.sleep(self.delay)
+QUEUE_SIZE = 1000  # lines buffered between the sources and the dispatcher
+INPUT_QUEUE_SIZE = 10000  # lines buffered between the dispatcher and the GUI
+INPUT_QUEUE_RETRY = 0.01  # s between attempts to put into a full GUI queue
+SERIAL_POLL = 0.05  # s, how often the serial port is checked for new bytes
+SERIAL_TIMEOUT = 30.0  # s without data before the serial source reports it
+ENCODER_INTERVAL = 0.1  # s between encoder reads
+ENCODER_TIMEOUT = 1.0  # s, a modbus read taking longer is given up
+NETWORK_TIMEOUT = 30.0  # s without data before a network source reports it
 
-        return
 
-class SerialInputWorker(QtCore.QThread):
+class AcquisitionCore(QtCore.QThread):
 
-    update_signal = QtCore.pyqtSignal('QString', name = 'update')
-    serial = None
-    alive = False
-    port = ''
+    ready_signal = QtCore.pyqtSignal(name = 'ready')
+    depth_signal = QtCore.pyqtSignal(float, float, name = 'depth')
+    message_signal = QtCore.pyqtSignal('QString', name = 'message')
 
-    def __init__(self, port):
+    def __init__(self):
         QtCore.QThread.__init__(self)
-        self.alive = False
-        self.port = port
+        self.loop = None
+        self.queue = None
+        self.tasks = {}
+        self.ready = QtCore.QSemaphore(0)
+        # (line, received) for the GUI, see take_lines
+        self.lines = queue.Queue(INPUT_QUEUE_SIZE)
+        self.signalled = False
+        self.signal_lock = threading.Lock()
+        self.queued = 0  # lines handed to the GUI queue in total
+        # blocking driver calls (minimalmodbus) run here, off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        QtCore.QThread.start(self)
+        self.ready.acquire()  # wait until the loop accepts sources
 
-        self.serial = serial.Serial(
-            self.port,
-            baudrate=600,
-            bytesize=serial.EIGHTBITS,
-            parity=serial.PARITY_NONE,
-            stopbits=serial.STOPBITS_ONE,
-            timeout=5
-        )
-
-    def __del__(self):
-        self.stop()
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        dispatcher = self.loop.create_task(self.dispatch())
+        self.ready.release()
+        try:
+            self.loop.run_forever()
+        finally:
+            pending = [dispatcher] + list(self.tasks.values())
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.tasks = {}
+            self.loop.close()
+            self.loop = None
 
     def stop(self):
-        self.alive = False
-        self.serial.close()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
         self.wait()
+        self.executor.shutdown(wait=False)
 
-    def run(self):
-        self.alive = True
-        while self.alive:
-            try:
-                line = self.serial.readline()
+    # --- called from the GUI thread
 
-                # # cap to 7 bit strings
-                # result = ""
-                # for char in line:
-                #     result += chr(ord(char) & 0x7f)
+    def add_source(self, name, coroutine):
+        """Runs coroutine as source `name`, replacing a running source of that name"""
+        self.loop.call_soon_threadsafe(self._add_source, name, coroutine)
 
-                #self.emit( QtCore.SIGNAL('update(QString)'), result.rstrip())
-                self.update_signal.emit(line.decode(encoding='UTF-8',errors='ignore').rstrip())  
+    def remove_source(self, name):
+        self.loop.call_soon_threadsafe(self._remove_source, name)
 
-            except serial.SerialTimeoutException:
-                pass
-        return
\ No newline at end of file
+    def has_source(self, name):
+        task = self.tasks.get(name)
+        return task is not None and not task.done()
+
+    def take_lines(self, limit):
+        """Up to limit queued (line, received) items, oldest first. Call on ready_signal"""
+        with self.signal_lock:
+            self.signalled = False
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(self.lines.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def backlog(self):
+        return self.lines.qsize()
+
+    # --- running on the event loop
+
+    def _add_source(self, name, coroutine):
+        self._remove_source(name)
+        task = self.loop.create_task(coroutine)
+        task.add_done_callback(lambda t: self._source_done(name, t))
+        self.tasks[name] = task
+
+    def _remove_source(self, name):
+        task = self.tasks.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+    def _source_done(self, name, task):
+        if self.tasks.get(name) is task:
+            del self.tasks[name]
+        if not task.cancelled() and task.exception() is not None:
+            self.message("%s: stopped with error: %s" % (name, task.exception()))
+
+    async def put(self, line, received):
+        await self.queue.put((line, received))
+
+    async def dispatch(self):
+        while True:
+            item = await self.queue.get()
+            while True:
+                try:
+                    self.lines.put_nowait(item)
+                    break
+                except queue.Full:
+                    await asyncio.sleep(INPUT_QUEUE_RETRY)
+            self.queued += 1
+            with self.signal_lock:
+                signal = not self.signalled
+                self.signalled = True
+            if signal:
+                self.ready_signal.emit()
+
+    def message(self, text):
+        self.message_signal.emit(text)
+
+    async def call(self, function, *args, timeout=None):
+        """Runs a blocking call in the driver executor, without blocking the event loop"""
+        return await asyncio.wait_for(self.loop.run_in_executor(self.executor, function, *args), timeout)
+
+
+def open_logger_serial(port):
+    return serial.Serial(
+        port,
+        baudrate=600,
+        bytesize=serial.EIGHTBITS,
+        parity=serial.PARITY_NONE,
+        stopbits=serial.STOPBITS_ONE,
+        timeout=0,
+    )
+
+
+async def serial_source(core, port):
+    """DL20 lines from an opened serial port. The port is polled, so no thread blocks on it"""
+    buffer = b""
+    last = time.perf_counter()
+    try:
+        while True:
+            waiting = port.in_waiting
+            if waiting:
+                buffer += port.read(waiting)
+                received = time.perf_counter()
+                last = received
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    await core.put(line.decode(encoding='UTF-8', errors='ignore').rstrip(), received)
+            elif time.perf_counter() - last > SERIAL_TIMEOUT:
+                core.message("Serial: no data for %.0f s" % SERIAL_TIMEOUT)
+                last = time.perf_counter()
+            await asyncio.sleep(SERIAL_POLL)
+    finally:
+        port.close()
+
+
+async def file_source(core, filename, delay):
+    """Replays a .raw/.TXT or compressed .rawz file, one line per `delay` seconds"""
+    for line in rawarchive.iter_raw_lines(filename):
+        await core.put(line.rstrip(), time.perf_counter())
+        await asyncio.sleep(delay)
+    core.message("File input: End of file")
+
+
+async def encoder_source(core, encoder):
+    """Polls the Codex560 main counter and emits (counter, time read)"""
+    failing = False
+    try:
+        while True:
+            try:
+                value = await core.call(encoder.get_main_counter, timeout=ENCODER_TIMEOUT)
+                core.depth_signal.emit(float(value), time.perf_counter())
+                failing = False
+            except Exception as e:
+                # no depth rather than the last good one, which goes stale
+                core.depth_signal.emit(math.nan, time.perf_counter())
+                if not failing:
+                    core.message("Encoder: read failed (%s)" % (str(e) or type(e).__name__))
+                failing = True
+            await asyncio.sleep(ENCODER_INTERVAL)
+    finally:
+        # the port stays open if a new encoder connection on it replaced this source
+        encoder.release()
+
+
+async def tcp_source(core, host, port):
+    """DL20 lines from a TCP stream (e.g. a serial-to-ethernet converter)"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            try:
+                line = await asyncio.wait_for(reader.readline(), NETWORK_TIMEOUT)
+            except asyncio.TimeoutError:
+                core.message("Network: no data for %.0f s" % NETWORK_TIMEOUT)
+                continue
+            if not line:
+                core.message("Network: connection closed")
+                return
+            await core.put(line.decode(encoding='UTF-8', errors='ignore').rstrip(), time.perf_counter())
+    finally:
+        writer.close()